@@ -0,0 +1,150 @@
+"""Keeps long jobs from getting in the way of games being played
+
+`enable` drops the CPU and disk priority of this process, which anything it
+starts (like ffmpeg) inherits, and turns on `checkpoint`. Slow loops call
+`checkpoint` between files to cap disk throughput and to wait while an
+emulator is running.
+"""
+import ctypes
+import os
+import platform
+import threading
+import time
+
+# Process names of emulators, and of the RetroPie launcher that runs them
+EMULATOR_PROCESSES = frozenset(
+    ("runcommand.sh", "retroarch", "mupen64plus", "PPSSPPSDL", "reicast",
+     "redream", "dosbox", "scummvm", "amiberry", "advmame", "mame",
+     "drastic", "hatari", "fuse", "openmsx", "stella", "vice"))
+
+# Default cap on disk throughput, in bytes per second
+DEFAULT_RATE = 5 * 1000 * 1000
+
+# Seconds between checks of /proc for a running emulator
+POLL_INTERVAL = 5
+
+# ioprio_set syscall numbers, which differ by architecture
+_IOPRIO_SET = {
+    "x86_64": 251,
+    "i686": 289,
+    "aarch64": 30,
+    "armv6l": 314,
+    "armv7l": 314,
+}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_IDLE = 3
+_IOPRIO_CLASS_SHIFT = 13
+
+_enabled = False
+_bucket = None
+_poll_lock = threading.Lock()
+_last_poll = 0
+
+
+class TokenBucket:
+    """Limits the average rate of something, allowing short bursts"""
+    def __init__(self, rate, burst=None):
+        """Constructor"""
+        self.rate = rate
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """Takes amount tokens, sleeping until the rate allows it
+
+        Amounts bigger than the bucket are allowed, the wait afterwards is
+        just longer.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def set_idle_io_priority():
+    """Puts this process in the idle I/O scheduling class, like `ionice -c3`"""
+    number = _IOPRIO_SET.get(platform.machine())
+    if number is None:
+        raise OSError(f"Don't know ioprio_set on {platform.machine()}")
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(number, _IOPRIO_WHO_PROCESS, 0,
+                    _IOPRIO_CLASS_IDLE << _IOPRIO_CLASS_SHIFT) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+def running_emulator():
+    """Returns the name of an emulator that is being played, or None
+
+    An emulator counts if it's in the foreground of its terminal, or has no
+    terminal at all (started from a desktop).
+    """
+    try:
+        pids = [entry for entry in os.listdir("/proc") if entry.isdigit()]
+    except OSError:
+        return None
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat", "r") as handle:
+                stat = handle.read()
+        except OSError:
+            # Already exited
+            continue
+        # The name is in parentheses and can contain spaces
+        name = stat[stat.find("(") + 1:stat.rfind(")")]
+        if name not in EMULATOR_PROCESSES:
+            continue
+        # state ppid pgrp session tty_nr tpgid ...
+        fields = stat[stat.rfind(")") + 2:].split()
+        process_group, terminal, foreground_group = int(fields[2]), int(
+            fields[4]), int(fields[5])
+        if terminal == 0 or process_group == foreground_group:
+            return name
+    return None
+
+
+def enable(rate=DEFAULT_RATE):
+    """Lowers the priority of this process and turns on `checkpoint`
+
+    `rate` caps the bytes per second passed to `checkpoint`, None for no cap.
+    """
+    global _enabled, _bucket
+    os.setpriority(os.PRIO_PROCESS, 0, 19)
+    try:
+        set_idle_io_priority()
+    except OSError as error:
+        print(f"WARNING: Could not lower I/O priority: {error}")
+    _bucket = TokenBucket(rate) if rate else None
+    _enabled = True
+
+
+def wait_for_emulators():
+    """Blocks while an emulator is running, checking every POLL_INTERVAL"""
+    global _last_poll
+    with _poll_lock:
+        if time.monotonic() - _last_poll < POLL_INTERVAL:
+            return
+        name = running_emulator()
+        if name is not None:
+            print(f"Paused while {name} is running")
+            while name is not None:
+                time.sleep(POLL_INTERVAL)
+                name = running_emulator()
+            print("Resuming")
+        _last_poll = time.monotonic()
+
+
+def checkpoint(byte_count=0):
+    """Called before reading or writing byte_count bytes in background mode"""
+    if not _enabled:
+        return
+    wait_for_emulators()
+    if _bucket is not None and byte_count:
+        _bucket.consume(byte_count)
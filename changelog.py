@@ -0,0 +1,102 @@
+"""Structured log of the changes made to the gamelists and kidlist
+
+Every change is an event with a type, system, game and field. Only the
+number of events of each type is kept in memory, the details are streamed to
+stdout (or to a JSONL file) as they happen, optionally up to a cap, so mass
+operations don't pile up thousands of strings.
+"""
+import json
+import sys
+from collections import Counter
+
+
+class ChangeLog:
+    """Counts change events and streams their details"""
+    def __init__(self, path=None, max_details=None, stream=sys.stdout):
+        """Constructor
+
+        With a `path`, details are written there as JSON lines instead of
+        to `stream`. After `max_details` events only counts are kept.
+        """
+        self._stream = stream
+        self._handle = open(path, "w") if path else None
+        self._max_details = max_details
+        self._details = 0
+        self._suppressed = 0
+        # (source, system, notice) -> Counter of event types
+        self._counts = {}
+        self._last_heading = None
+
+    def record(self,
+               source,
+               system,
+               change_type,
+               message,
+               game=None,
+               field=None,
+               notice=False):
+        """Records one change to `source` ("gamelist" or "kidlist")"""
+        self._counts.setdefault((source, system, notice),
+                                Counter())[change_type] += 1
+        if self._max_details is not None and self._details >= self._max_details:
+            self._suppressed += 1
+            return
+        self._details += 1
+
+        if self._handle is not None:
+            self._handle.write(
+                json.dumps({
+                    "source": source,
+                    "system": system,
+                    "type": change_type,
+                    "game": game,
+                    "field": field,
+                    "notice": notice,
+                    "message": message
+                }) + "\n")
+            return
+
+        kind = "Notices about" if notice else "Changes to"
+        heading = f"{kind} {system}'s {source}"
+        if heading != self._last_heading:
+            if self._last_heading is not None:
+                print(file=self._stream)
+            print(heading, file=self._stream)
+            print("=" * len(heading), file=self._stream)
+            self._last_heading = heading
+        print(message, file=self._stream)
+
+    def count(self, source, system=None, notice=False):
+        """Returns the number of changes to source (and system)"""
+        return sum(
+            sum(counts.values())
+            for (count_source, count_system,
+                 count_notice), counts in self._counts.items()
+            if count_source == source and count_notice == notice and (
+                system is None or count_system == system))
+
+    def systems(self, source, notice=False):
+        """Returns the systems of source that have events"""
+        return sorted({
+            system
+            for count_source, system, count_notice in self._counts
+            if count_source == source and count_notice == notice
+        })
+
+    def summary(self):
+        """Returns lines with the number of changes of each type"""
+        lines = []
+        for (source, system, notice), counts in sorted(self._counts.items()):
+            kinds = ", ".join(f"{count} {change_type}"
+                              for change_type, count in sorted(counts.items()))
+            label = "notices" if notice else "changes"
+            lines.append(f"{system}'s {source} {label}: {kinds}")
+        if self._suppressed:
+            lines.append(f"{self._suppressed} more changes not shown")
+        return lines
+
+    def close(self):
+        """Finishes writing the details"""
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
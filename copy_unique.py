@@ -1,222 +1,911 @@
 import argparse
-import glob
 import os.path
 import json
 import re
 import time
-import string  # For punctuation characters
-from shutil import copyfile
-import xml.etree.ElementTree as ET
 import configparser
+import contextlib
+import functools
+import hashlib
+import io
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import fsio
+import romindex
+import romtags
+import xmltree
 
 DEFAULT_EXCLUDES = ("* Mature *", "Mahjong", "Lightgun", "Tabletop", "Quiz",
                     "Japanese", "BIOS", "Print Club")
 DEFAULT_CATVER = os.path.expanduser("~/Documents/catver.ini")
 DEFAULT_MAME_XML = os.path.expanduser("~/Documents/mame2003.xml")
+# Games handled between each batch of stats and transfers
+GROUP_BATCH_SIZE = 512
+# Kept in the target folder to make the next run incremental
+MANIFEST_NAME = ".copy_unique-manifest.json"
+# Where data derived from the whitelist and catver.ini is kept between runs
+DEFAULT_CACHE_DIR = os.path.expanduser("~/.cache/copy_unique")
+
+# Rules used by RomRanker to pick one rom of each game, override with --rules
+DEFAULT_RULES = {
+    # Roms with any of these tags are never picked
+    "reject": [
+        "Beta", "Beta 1", "Beta 2", "Rev 1", "Rev 2", "Proto 1", "Proto 2",
+        "Sample", "Unl", "Proto", "Ge", "Nintendo Switch", "Test Program",
+        "Demo", "Genesis Mini", "Enhancement Chip"
+    ],
+    # Roms need at least one of these tags (acceptable regions)
+    "require": ["USA", "World"],
+    # The best weight of the required tags picks the region first, then a rom
+    # tagged with nothing but its region wins, then the other weights add up
+    "weights": {
+        "USA": 1000,
+        "World": 500,
+        "Namco": 400,
+        "UBI Soft": 200,
+        "Tengen": 100,
+        "Virtual Console": 50,
+        "En": 10,
+        "GameCube Edition": -5
+    },
+    # Subtracted for each tag after the first, only to break ties
+    "tag_penalty": 1
+}
+
+# Roms, and the one the original list filtering picked, for --check-rules
+LEGACY_PICKS = (
+    (("Game (World).zip", "Game (USA, Europe) (En,Fr,De,Es,It).zip"),
+     "Game (USA, Europe) (En,Fr,De,Es,It).zip"),
+    (("Game (USA, Europe).zip", "Game (USA) (En,Fr).zip"),
+     "Game (USA) (En,Fr).zip"),
+    (("Game (USA).zip", "Game (USA) (En,Fr).zip", "Game (Europe).zip"),
+     "Game (USA).zip"),
+    (("Game (USA).zip", "Game (USA, Europe).zip", "Game (World).zip"),
+     "Game (USA).zip"),
+    (("Game (World).zip", "Game (Japan).zip", "Game (Europe).zip"),
+     "Game (World).zip"),
+    (("Game (USA) (Beta).zip", "Game (World).zip"), "Game (World).zip"),
+    (("Game (USA) (Proto).zip", "Game (USA) (Demo).zip"), None),
+    (("Game (USA) (Namco).zip", "Game (USA) (Tengen).zip"),
+     "Game (USA) (Namco).zip"),
+    (("Game (USA) (Tengen) (En).zip", "Game (USA) (UBI Soft).zip"),
+     "Game (USA) (UBI Soft).zip"),
+    (("Game (USA) (Virtual Console).zip", "Game (USA, Europe).zip"),
+     "Game (USA) (Virtual Console).zip"),
+    (("Game (USA) (GameCube Edition).zip", "Game (USA) (Rev A).zip"),
+     "Game (USA) (Rev A).zip"),
+    (("Game (USA) (En) (GameCube Edition).zip", "Game (USA) (Fr).zip"),
+     "Game (USA) (En) (GameCube Edition).zip"),
+)
 
 
 def rom_name_and_tags(path):
     """Returns the name of a rom, and a list of tags"""
-    full_name = os.path.splitext(os.path.basename(path))[0]
-    paren_start = full_name.find(" (")
-
-    def standardize_name(name):
-        replacements = [("&", "and")]
-        for replacement in replacements:
-            name = name.replace(replacement[0], replacement[1])
-        no_punctuation = ''.join(ch for ch in name.lower()
-                                 if ch not in set(string.punctuation))
-        return no_punctuation
-
-    tags = []
-    if paren_start > 0:
-        # Split all the tokens at commas
-        tokens = re.findall(r"\(([^/)]+)\)", full_name)
-        for token in tokens:
-            for t in token.split(","):
-                tags.append(t.strip())
-        return standardize_name(full_name[:paren_start]), tags
-    return standardize_name(full_name), tags
+    return romtags.rom_name_and_tags(path)
+
+
+def scan_roms(source, extensions, ignore, errors=None):
+    """Yields the paths of the roms in source, in directory order
+
+    An error listing source is printed, and added to `errors` if given,
+    instead of raised.
+    """
+    ignore_pattern = re.compile(ignore)
+    try:
+        for path in fsio.iter_files(source, extensions):
+            if ignore_pattern.search(os.path.basename(path)) is None:
+                yield path
+    except OSError as error:
+        print(f"ERROR: Could not list {source}: {error}")
+        if errors is not None:
+            errors.append(error)
+
+
+def group_roms(paths):
+    """Yields (name, hits) for each game, where hits are keyed by tag string
+
+    Every (name, path) is held and sorted by game name up front, so memory
+    grows with the number of roms. After that each game is yielded as soon
+    as all of its roms have been seen. Roms whose tags collide with another
+    rom of the same game are reported and left out.
+    """
+    keyed = sorted((romtags.parse(path).name, path) for path in paths)
+    for name, group in itertools.groupby(keyed, key=lambda item: item[0]):
+        hits = {}
+        for _, path in group:
+            tags = romtags.parse(path).tags
+            tag_string = "|".join(tags)
+            if tag_string in hits:
+                print(f"Duplicate tags for {name}: ignoring {path} "
+                      f"(same as {hits[tag_string]['path']})")
+                continue
+            hits[tag_string] = {"path": path, "tags": tags}
+        yield name, hits
 
 
 def sort_roms(unsorted):
     """Combines roms into bins by their name"""
-    sorted_roms = {}
-    for rom in unsorted:
-        name, tags = rom_name_and_tags(rom)
-        tag_string = "|".join(tags)
-        if name not in sorted_roms:
-            sorted_roms[name] = {}
-        if tag_string in sorted_roms[name]:
-            raise RuntimeError("Surprising duplication of tags")
-        sorted_roms[name][tag_string] = {"path": rom, "tags": tags}
-    return sorted_roms
-
-
-def get_best_rom(hits, show_failure=False):
-    """Returns the best hit using some simple rules"""
-    hits_orig = hits[:]
-
-    # Acceptable regions
-    REGIONS = ["USA", "World"]
-    # List of tags that are an auto-rejected
-    IGNORE = [
-        "Beta", "Beta 1", "Beta 2", "Rev 1", "Rev 2", "Proto 1", "Proto 2",
-        "Sample", "Unl", "Proto", "Ge", "Nintendo Switch", "Test Program",
-        "Demo", "Genesis Mini", "Enhancement Chip"
-    ]
-    # If multiple maker tags are present, then pick one in this order
-    MAKER = ["Namco", "UBI Soft", "Tengen", "Virtual Console"]
-    # Preferred language
-    LANGUAGE = ["En"]
-    # Strip these out, if one survives then use it
-    PREFER_NOT = ["GameCube Edition"]
-
-    # Ignore
-    hits = [
-        hit for hit in hits
-        if not any([ignore in hit["tags"] for ignore in IGNORE])
-    ]
-
-    def match_preferred(hits, tokens):
-        for token in tokens:
-            new_hits = []
-            for hit in hits:
-                if token in hit["tags"]:
-                    if len(hit["tags"]) == 1:
-                        return [hit]
-                    new_hits.append(hit)
-            if len(new_hits):
-                return new_hits
-        return []
-
-    def match_not_preferred(hits, tokens):
-        for token in tokens:
-            new_hits = []
-            for hit in hits:
-                if token not in hit["tags"]:
-                    if len(hit["tags"]) == 1:
-                        return [hit]
-                    new_hits.append(hit)
-            if new_hits:
-                return new_hits
-        return []
-
-    hits_region = match_preferred(hits, REGIONS)
-    if len(hits_region) == 1:
-        return hits_region[0]["path"]
-
-    if len(hits_region) == 0:
-        if show_failure:
-            print("Failed to find preferred region")
-            if len(hits):
-                print(json.dumps(hits, indent=2))
+    return dict(group_roms(unsorted))
+
+
+def chunked(iterable, size):
+    """Yields lists of up to `size` items from iterable"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class RomRanker:
+    """Picks the best rom of a group (1G1R) by scoring its tags
+
+    Each tag gets a bit the first time it's seen, so the reject and require
+    checks are a single mask test and scores are cached per tag combination.
+    Scores are tuples compared in order: the region (the best weight of the
+    required tags), whether the rom has no other tags, the sum of the other
+    weights, and the tag penalty.
+    """
+    def __init__(self, rules=None):
+        """Constructor"""
+        if rules is None:
+            rules = DEFAULT_RULES
+        self.rules = rules
+        self._bits = {}
+        self._reject = self._mask(rules["reject"])
+        self._require = self._mask(rules["require"])
+        self._weights = dict(rules["weights"])
+        self._tag_penalty = rules["tag_penalty"]
+        self._scores = {}
+
+    def _mask(self, tags):
+        """Returns the bitset of tags, giving new tags the next free bit"""
+        mask = 0
+        for tag in tags:
+            bit = self._bits.get(tag)
+            if bit is None:
+                bit = self._bits[tag] = 1 << len(self._bits)
+            mask |= bit
+        return mask
+
+    def score(self, tags):
+        """Returns the score of a rom with these tags, None if it's rejected"""
+        key = (self._mask(tags), len(tags))
+        if key not in self._scores:
+            mask = key[0]
+            if mask & self._reject or not mask & self._require:
+                self._scores[key] = None
             else:
-                print(json.dumps(hits_orig, indent=2))
-            input("[Enter to continue]")
-        return None
-    hits = hits_region
+                regions = set(self.rules["require"])
+                region = max(
+                    self._weights.get(tag, 0) for tag in tags
+                    if tag in regions)
+                others = sum(
+                    self._weights.get(tag, 0) for tag in set(tags)
+                    if tag not in regions)
+                self._scores[key] = (region, not mask & ~self._require,
+                                     others, -self._tag_penalty *
+                                     max(0, len(tags) - 1))
+        return self._scores[key]
+
+    def best(self, hits):
+        """Returns the best of the hits, or None if all are rejected
+
+        Ties go to the rom with fewer tags, then to the first path.
+        """
+        best_hit, best_key = None, None
+        for hit in hits:
+            score = self.score(hit["tags"])
+            if score is None:
+                continue
+            key = (tuple(-value for value in score), len(hit["tags"]),
+                   hit["path"])
+            if best_key is None or key < best_key:
+                best_hit, best_key = hit, key
+        return best_hit
 
-    preferences = [(MAKER, True), (LANGUAGE, True), (PREFER_NOT, False)]
 
-    for preference in preferences:
-        new_hits = match_preferred(
-            hits, preference[0]) if preference[1] else match_not_preferred(
-                hits, preference[0])
-        if len(new_hits) == 1:
-            return new_hits[0]["path"]
+def read_rules(rules_path):
+    """Reads ranking rules from an ini file, see DEFAULT_RULES for defaults"""
+    config = configparser.ConfigParser()
+    # Tags are case sensitive
+    config.optionxform = str
+    config.read(rules_path)
+    rules = dict(DEFAULT_RULES)
+    if config.has_section("rules"):
+        section = config["rules"]
+        for key in ("reject", "require"):
+            if key in section:
+                rules[key] = [
+                    tag.strip() for tag in section[key].split(",")
+                    if tag.strip()
+                ]
+        if "tag_penalty" in section:
+            rules["tag_penalty"] = section.getint("tag_penalty")
+    if config.has_section("weights"):
+        rules["weights"] = dict(DEFAULT_RULES["weights"])
+        rules["weights"].update({
+            tag: int(weight)
+            for tag, weight in config["weights"].items()
+        })
+    return rules
+
+
+def get_best_rom(hits, show_failure=False, ranker=None):
+    """Returns the path of the best hit using the ranking rules"""
+    if ranker is None:
+        ranker = RomRanker()
+    best = ranker.best(hits)
+    if best is not None:
+        return best["path"]
 
     if show_failure:
+        print("Failed to find an acceptable rom")
         print(json.dumps(hits, indent=2))
         input("[Enter to continue]")
     return None
 
 
-def copy_roms(source, ignore, target, extension, action, do_copy, show_failure,
-              whitelist, blacklist):
-    """Copies unique versions of roms in `source` to the folder `target`"""
-    paths = [
-        path for path in glob.glob(os.path.join(source, f"*.{extension}"))
-        if re.search(ignore, os.path.basename(path)) is None
-    ]
-    roms_by_name = sort_roms(paths)
-    successes = 0
-    for name, hits in roms_by_name.items():
-        if blacklist:
-            if name in blacklist:
-                print(f"Blacklisting {name}")
-                continue
-
-        if whitelist:
-            if name not in whitelist:
-                print(f"Filtering {name}")
-                continue
-            path = list(hits.values())[0]["path"]
-        else:
-            path = get_best_rom(list(hits.values()), show_failure)
+def check_rules(ranker):
+    """Prints the LEGACY_PICKS that ranker picks differently
+
+    Returns the number of differences.
+    """
+    differences = 0
+    for names, expected in LEGACY_PICKS:
+        hits = [{
+            "path": name,
+            "tags": romtags.parse(name).tags
+        } for name in names]
+        picked = get_best_rom(hits, ranker=ranker)
+        if picked != expected:
+            differences += 1
+            print(f"{', '.join(names)}: picked {picked}, "
+                  f"used to pick {expected}")
+    print(f"{len(LEGACY_PICKS) - differences} of {len(LEGACY_PICKS)} picks "
+          f"match the original rules")
+    return differences
+
+
+class Manifest:
+    """What the last run decided for each game, kept in the target folder
+
+    A game whose rom files haven't changed since then, and whose target is
+    still there, doesn't need to be looked at again. After a change to the
+    settings (or with `reuse` off) every game is decided again, but the
+    targets the last run placed are still known so they can be removed.
+
+    Targets are kept as file names inside the target folder and members as
+    paths relative to the source, so it doesn't matter where it's run from.
+    """
+    def __init__(self, target, settings, reuse=True):
+        """Constructor"""
+        self._target = target
+        self._path = os.path.join(target, MANIFEST_NAME)
+        self._settings = settings
+        # The decisions that can be trusted, and all of the last run's
+        self.groups = {}
+        self.previous = {}
+        if os.path.exists(self._path):
+            with open(self._path, "r") as handle:
+                saved = json.load(handle)
+            self.previous = saved["groups"]
+            if reuse and saved.get("settings") == settings:
+                self.groups = dict(self.previous)
+        self._present = None
+
+    def unchanged(self, name, members):
+        """Whether the game `name` has exactly the same files as last time"""
+        entry = self.groups.get(name)
+        if entry is None or entry["members"] != members:
+            return False
+        if entry["target"] is None:
+            return True
+        if self._present is None:
+            # One listing instead of a stat per game
+            try:
+                self._present = set(os.listdir(self._target))
+            except OSError:
+                self._present = set()
+        return os.path.basename(entry["target"]) in self._present
+
+    def previous_target(self, name):
+        """Returns the file name the last run gave the game `name`, or None"""
+        entry = self.previous.get(name)
+        if not entry or not entry["target"]:
+            return None
+        # Older manifests kept the whole (possibly relative) path
+        return os.path.basename(entry["target"])
+
+    def inside(self, path):
+        """Whether path is a file directly inside the target folder"""
+        # Not realpath(path), as a link target points into the source
+        return os.path.realpath(os.path.dirname(
+            os.path.abspath(path))) == os.path.realpath(self._target)
+
+    def save(self):
+        """Writes the manifest"""
+        os.makedirs(self._target, exist_ok=True)
+        with open(self._path, "w") as handle:
+            json.dump({
+                "settings": self._settings,
+                "groups": self.groups
+            }, handle)
+
+
+def settings_digest(*settings):
+    """Returns a short digest of everything that affects which roms are picked"""
+    def normalize(value):
+        if isinstance(value, (set, frozenset)):
+            return sorted(value)
+        return value
+
+    encoded = json.dumps([normalize(setting) for setting in settings],
+                         sort_keys=True)
+    return hashlib.sha1(encoded.encode()).hexdigest()
+
+
+def pick_rom(name, hits, whitelist, blacklist, best, log=print):
+    """Returns the path of the rom to keep for the game `name`, or None
+
+    `best` returns the ranked pick, it's only called when it's needed.
+    """
+    if blacklist:
+        if name in blacklist:
+            log(f"Blacklisting {name}")
+            return None
+
+    if whitelist:
+        if name not in whitelist:
+            log(f"Filtering {name}")
+            return None
+        path = list(hits.values())[0]["path"]
+    else:
+        path = best()
+
+    if path is None:
+        log(f"Skipping {name}")
+    return path
+
+
+class Profile:
+    """One curated set made from a source: its filters, target and progress"""
+    def __init__(self,
+                 target,
+                 action,
+                 whitelist,
+                 blacklist,
+                 settings,
+                 full=False,
+                 name=None):
+        """Constructor
+
+        `settings` are the (ignore, extensions, rules) shared by all the
+        profiles of a source. Output is prefixed with `name` if given.
+        """
+        self.target = target
+        self.action = action
+        self.whitelist = whitelist
+        self.blacklist = blacklist
+        self._prefix = f"[{name}] " if name else ""
+        self.manifest = None
+        if action in fsio.TRANSFER_ACTIONS:
+            # A full run rebuilds the manifest from scratch
+            self.manifest = Manifest(
+                target,
+                settings_digest(action, *settings, whitelist, blacklist),
+                reuse=not full)
+        self.picked = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.summary = {
+            "files": 0,
+            "skipped": 0,
+            "failed": [],
+            "bytes": 0,
+            "seconds": 0
+        }
+        self._transfers = []
+        self._names_by_target = {}
+        self._removals = []
+
+    def log(self, message):
+        """Prints a message about this profile"""
+        print(f"{self._prefix}{message}")
+
+    def add(self, name, hits, members, best):
+        """Decides what to do with one game, see `pick_rom`"""
+        manifest = self.manifest
+        if manifest is not None and manifest.unchanged(name, members):
+            self.unchanged += 1
+            self.picked += bool(manifest.groups[name]["winner"])
+            return
+
+        path = pick_rom(name, hits, self.whitelist, self.blacklist, best,
+                        self.log)
+        target_name = target_path = None
+        if path is not None:
+            self.picked += 1
+            target_name = os.path.basename(path)
+            target_path = os.path.join(self.target, target_name)
+
+        if manifest is not None:
+            previous_target = manifest.previous_target(name)
+            if previous_target and previous_target != target_name:
+                self._removals.append(
+                    os.path.join(self.target, previous_target))
+            manifest.groups[name] = {
+                "members": members,
+                "winner": path is not None,
+                "target": target_name
+            }
 
         if path is None:
-            print(f"Skipping {name}")
-            continue
-
-        successes += 1
-        target_path = os.path.join(target, os.path.basename(path))
-
-        if action == "link":
-            print(f"{name}: {path} ~> {target_path}")
-            if do_copy and not os.path.exists(target_path):
-                os.symlink(os.path.abspath(path), os.path.abspath(target_path))
-        elif action == "copy":
-            print(f"{name}: {path} -> {target_path}")
-            if do_copy:
-                copyfile(os.path.abspath(path), os.path.abspath(target_path))
-        elif action == "clean":
+            return
+
+        if self.action in fsio.TRANSFER_ACTIONS:
+            arrow = "~>" if self.action == "link" else "->"
+            self.log(f"{name}: {path} {arrow} {target_path}")
+            self._transfers.append(
+                (os.path.abspath(path), os.path.abspath(target_path)))
+            self._names_by_target[os.path.abspath(target_path)] = name
+        elif self.action == "clean":
             if len(hits.values()) > 1:
-                print(hits)
+                self.log(hits)
             for hit in hits.values():
                 if hit["path"] != path:
-                    print(f'rm {hit["path"]}')
+                    self.log(f'rm {hit["path"]}')
                 else:
                     pass
                     #print(hit)
         else:
-            raise RuntimeError(f"Unknown action {action}")
-
-    if do_copy:
-        print(f"Copied {successes} games")
-    else:
-        print(f"Would have copied {successes} games")
-
-
-def read_filter(filter_path):
-    """Returns a list of game names to keep"""
-    tree = ET.parse(filter_path)
-    return [
-        game.attrib["name"] for game in tree.getroot().findall("game")
-        if not any([token in game.attrib for token in ["cloneof"]])
+            raise RuntimeError(f"Unknown action {self.action}")
+
+    def _safe_removals(self, removals):
+        """Returns the removals that are inside the target folder"""
+        if self.manifest is None:
+            return removals
+        safe = []
+        for removal in removals:
+            if self.manifest.inside(removal):
+                safe.append(removal)
+            else:
+                self.log(f"ERROR: Not removing {removal}, it isn't in "
+                         f"{self.target}")
+        return safe
+
+    def flush(self, fs, do_copy):
+        """Carries out the removals and transfers decided so far"""
+        self._removals = self._safe_removals(self._removals)
+        for removal in self._removals:
+            self.log(f"Removing {removal}, no longer picked")
+        self.removed += len(self._removals)
+        if do_copy:
+            fs.remove_many(self._removals, missing_ok=True)
+            if self._transfers:
+                os.makedirs(self.target, exist_ok=True)
+                result = fs.transfer_many(self._transfers, self.action)
+                for key in ("files", "skipped", "failed", "bytes",
+                            "seconds"):
+                    self.summary[key] += result[key]
+                if self.manifest is not None:
+                    # Try the failures again next time
+                    for _, target_path in result["failed"]:
+                        self.manifest.groups.pop(
+                            self._names_by_target[target_path], None)
+        self._transfers = []
+        self._names_by_target = {}
+        self._removals = []
+
+    def finish(self, fs, do_copy, seen, source, complete=True):
+        """Removes games that are gone from source, returns a summary
+
+        If source couldn't be listed (`complete` is False) nothing is
+        removed and the manifest is kept as it was, since the games that
+        weren't seen may still be there.
+        """
+        manifest = self.manifest
+        if manifest is not None:
+            removals = []
+            gone = set(manifest.previous) - seen if complete else set()
+            for name in gone:
+                if manifest.previous_target(name):
+                    removals.append(
+                        os.path.join(self.target,
+                                     manifest.previous_target(name)))
+                manifest.groups.pop(name, None)
+            removals = self._safe_removals(removals)
+            for removal in removals:
+                self.log(f"Removing {removal}, no longer in {source}")
+            self.removed += len(removals)
+            if do_copy and complete:
+                fs.remove_many(removals, missing_ok=True)
+                manifest.save()
+            if self.unchanged:
+                self.log(
+                    f"{self.unchanged} games unchanged since the last run")
+
+        summary = self.summary
+        transferred = summary["files"] + summary["skipped"] + len(
+            summary["failed"])
+        if do_copy and transferred:
+            self.log(
+                f"Copied {summary['files']} games, {summary['skipped']} "
+                f"already up to date, {len(summary['failed'])} failed "
+                f"({fsio.format_rate(summary['bytes'], summary['seconds'])})")
+        elif do_copy and manifest is not None:
+            self.log(f"Nothing to copy, {self.picked} games up to date")
+        elif do_copy:
+            self.log(f"Copied {self.picked} games")
+        else:
+            self.log(f"Would have copied {self.picked} games")
+
+        return {
+            "picked": self.picked,
+            "unchanged": self.unchanged,
+            "copied": summary["files"],
+            "up_to_date": summary["skipped"],
+            "failed": len(summary["failed"]),
+            "removed": self.removed,
+            "bytes": summary["bytes"]
+        }
+
+
+def curate(source,
+           ignore,
+           extensions,
+           profiles,
+           do_copy,
+           show_failure=False,
+           jobs=fsio.DEFAULT_JOBS,
+           ranker=None):
+    """Makes every profile's curated set from one scan of source
+
+    Roms are found, grouped and statted once, and each game's best rom is
+    ranked at most once however many profiles use it. Games are statted,
+    picked and transferred in batches of GROUP_BATCH_SIZE, although the names
+    and paths of all the roms are held to sort them into games. Returns the
+    summary of each profile.
+    """
+    if ranker is None:
+        ranker = RomRanker()
+    fs = fsio.FileSystem(jobs)
+    seen = set()
+    errors = []
+    groups = group_roms(scan_roms(source, extensions, ignore, errors))
+    for chunk in chunked(groups, GROUP_BATCH_SIZE):
+        # Stat a whole batch at once so network latency overlaps
+        stats = fs.stat_many(hit["path"] for _, hits in chunk
+                             for hit in hits.values())
+        for name, hits in chunk:
+            seen.add(name)
+            members = {
+                os.path.relpath(path, source): [stat.st_size, stat.st_mtime_ns]
+                for path, stat in ((hit["path"], stats[hit["path"]])
+                                   for hit in hits.values())
+                if stat is not None
+            }
+            best = functools.lru_cache(maxsize=None)(functools.partial(
+                get_best_rom, list(hits.values()), show_failure, ranker))
+            for profile in profiles:
+                profile.add(name, hits, members, best)
+        for profile in profiles:
+            profile.flush(fs, do_copy)
+
+    results = [
+        profile.finish(fs, do_copy, seen, source, not errors)
+        for profile in profiles
     ]
+    fs.close()
+    return results
+
+
+def copy_roms(source,
+              ignore,
+              target,
+              extension,
+              action,
+              do_copy,
+              show_failure,
+              whitelist,
+              blacklist,
+              jobs=fsio.DEFAULT_JOBS,
+              ranker=None,
+              full=False):
+    """Copies unique versions of roms in `source` to the folder `target`
+
+    `extension` can be a single extension or a list of them. Unless `full`
+    is set, games whose files haven't changed since the last run (according
+    to the manifest in `target`) are skipped. Returns a summary dictionary
+    of what was done.
+    """
+    if ranker is None:
+        ranker = RomRanker()
+    extensions = [extension] if isinstance(extension, str) else extension
+    profile = Profile(target, action, whitelist, blacklist,
+                      (ignore, extensions, ranker.rules), full)
+    return curate(source, ignore, extensions, [profile], do_copy,
+                  show_failure, jobs, ranker)[0]
+
+
+def get_cache_path(source_path, kind):
+    """Returns where the data derived from source_path is cached"""
+    digest = hashlib.sha1(os.path.abspath(source_path).encode()).hexdigest()
+    return os.path.join(DEFAULT_CACHE_DIR, f"{kind}-{digest[:16]}.json")
+
+
+def read_cache(source_path, kind):
+    """Returns cached data derived from source_path, or None if it's stale"""
+    path = get_cache_path(source_path, kind)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as handle:
+        cached = json.load(handle)
+    if cached.get("fingerprint") != romindex.fingerprint(source_path):
+        return None
+    return cached["data"]
+
+
+def write_cache(source_path, kind, data):
+    """Caches data derived from source_path until source_path changes"""
+    os.makedirs(DEFAULT_CACHE_DIR, exist_ok=True)
+    with open(get_cache_path(source_path, kind), "w") as handle:
+        json.dump(
+            {
+                "fingerprint": romindex.fingerprint(source_path),
+                "data": data
+            }, handle)
+
+
+def read_filter(filter_path, use_cache=True):
+    """Returns the set of game names to keep (the ones that aren't clones)"""
+    if use_cache:
+        cached = read_cache(filter_path, "whitelist")
+        if cached is not None:
+            return set(cached)
+
+    names = set()
+    # Stream the xml, a full MAME listxml is far too big to hold as a tree
+    for element in xmltree.iterparse(filter_path, ("game", "machine")):
+        if "cloneof" not in element.attrib:
+            names.add(element.attrib["name"])
+
+    if use_cache:
+        write_cache(filter_path, "whitelist", sorted(names))
+    return names
+
+
+class CategoryIndex:
+    """Roms by category, and categories by rom, from a catver.ini"""
+    def __init__(self, categories):
+        """Constructor, `categories` maps each rom to its categories"""
+        self.categories = categories
+        self.roms = {}
+        for rom, rom_categories in categories.items():
+            for category in rom_categories:
+                self.roms.setdefault(category, set()).add(rom)
+
+    @classmethod
+    def read(cls, catver_path, use_cache=True):
+        """Reads the index from catver_path, or from the cache if it's current"""
+        if use_cache:
+            cached = read_cache(catver_path, "catver")
+            if cached is not None:
+                return cls(cached)
+        categories = parse_catver(catver_path)
+        if use_cache:
+            write_cache(catver_path, "catver", categories)
+        return cls(categories)
+
+    def roms_in(self, categories):
+        """Returns the set of roms in any of the categories"""
+        return set().union(*(self.roms.get(category, ())
+                             for category in categories))
+
+
+def parse_catver(catver_path):
+    """Returns a dictionary of categories for each rom in a catver.ini"""
+    categories = {}
+    in_section = False
+    with open(catver_path, "r", encoding="utf-8", errors="replace") as handle:
+        for line in handle:
+            line = line.strip()
+            if not line or line[0] in ";#":
+                continue
+            if line[0] == "[":
+                in_section = line == "[Category]"
+                continue
+            if not in_section or "=" not in line:
+                continue
+            name, catstring = line.split("=", 1)
+            name, catstring = name.strip().lower(), catstring.strip()
+            categories[name] = []
+            if "* Mature *" in catstring:
+                categories[name].append("* Mature *")
+                catstring = catstring[:-1 * len("* Mature *")].strip()
+            categories[name].extend(catstring.split(" / "))
+    return categories
 
 
 def read_catver(catver_path):
     """Returns a dictionary of categories for each rom"""
-    config = configparser.ConfigParser()
-    config.read(catver_path)
-    categories = {}
-    for name, catstring in config["Category"].items():
-        categories[name] = []
-        if "* Mature *" in catstring:
-            categories[name].append("* Mature *")
-            catstring = catstring[:-1 * len("* Mature *")].strip()
-        categories[name].extend(catstring.split(" / "))
-    return categories
+    return CategoryIndex.read(catver_path).categories
+
+
+def read_config(config_path):
+    """Returns the settings of each system in a batch config file
+
+    Each section is a system. Settings left out of a section come from the
+    [DEFAULT] section, then from the command line defaults, except that
+    there's no whitelist or catver.ini unless one is given.
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(config_path)
+
+    def split(value):
+        return [item.strip() for item in value.split(",") if item.strip()]
+
+    def path(value):
+        return os.path.expanduser(value) if value else None
+
+    systems = []
+    for name in config.sections():
+        section = config[name]
+        if section.get("exclude_categories") and not section.get("catver"):
+            print(f"WARNING: {name} sets exclude_categories without a "
+                  f"catver, no categories will be excluded")
+        systems.append({
+            "name": name,
+            "source": path(section["source"]),
+            "target": path(section["target"]),
+            "extensions": split(section.get("extensions", "zip")),
+            "ignore": section.get("ignore", r"^\["),
+            "action": section.get("action", "link"),
+            "whitelist": path(section.get("whitelist")),
+            "catver": path(section.get("catver")),
+            "exclude_categories": split(
+                section.get("exclude_categories",
+                            ", ".join(DEFAULT_EXCLUDES))),
+            "rules": path(section.get("rules")),
+        })
+    return systems
+
+
+def run_group(systems, filters, rules, do_copy, jobs, full):
+    """Curates systems that share a source in one pass, capturing the output
+
+    `filters` has the (whitelist, blacklist) of each system. Returns the
+    output and a dictionary of each system's summary.
+    """
+    first = systems[0]
+    ranker = RomRanker(rules)
+    settings = (first["ignore"], first["extensions"], ranker.rules)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        profiles = [
+            Profile(system["target"], system["action"], whitelist,
+                    blacklist, settings, full,
+                    system["name"] if len(systems) > 1 else None)
+            for system, (whitelist, blacklist) in zip(systems, filters)
+        ]
+        results = curate(first["source"], first["ignore"],
+                         first["extensions"], profiles, do_copy, False, jobs,
+                         ranker)
+    return output.getvalue(), {
+        system["name"]: result
+        for system, result in zip(systems, results)
+    }
+
+
+def run_batch(systems, do_copy, jobs, processes=None, full=False):
+    """Runs every system of a batch config on a process pool
+
+    Whitelists, catver.ini files and rules shared between systems are only
+    read once. Systems with the same source, extensions, ignore pattern and
+    rules are profiles of one curation, and share a single scan.
+    """
+    for system in systems:
+        if system["action"] not in fsio.TRANSFER_ACTIONS + ("clean", ):
+            print(f"{system['name']}: unknown action {system['action']}")
+            return
+
+    whitelists = {}
+    indexes = {}
+    rules = {}
+    for system in systems:
+        if system["whitelist"] and system["whitelist"] not in whitelists:
+            try:
+                whitelists[system["whitelist"]] = read_filter(
+                    system["whitelist"])
+            except (OSError, xmltree.ET.ParseError) as error:
+                print(f"ERROR: Could not read {system['whitelist']}: {error}")
+                whitelists[system["whitelist"]] = None
+        if system["catver"] and system["catver"] not in indexes:
+            if os.path.exists(system["catver"]):
+                indexes[system["catver"]] = CategoryIndex.read(
+                    system["catver"])
+            else:
+                print(f"Could not find {system['catver']}, not excluding "
+                      f"categories")
+                indexes[system["catver"]] = None
+        if system["rules"] and system["rules"] not in rules:
+            rules[system["rules"]] = read_rules(system["rules"])
+
+    groups = {}
+    for system in systems:
+        if system["whitelist"] and whitelists[system["whitelist"]] is None:
+            # Without its whitelist the system would get every game
+            print(f"{system['name']}: skipped, its whitelist couldn't be read")
+            continue
+        key = (system["source"], tuple(system["extensions"]),
+               system["ignore"], system["rules"])
+        groups.setdefault(key, []).append(system)
+
+    results = {}
+    with ProcessPoolExecutor(processes) as pool:
+        futures = {}
+        for group in groups.values():
+            filters = []
+            for system in group:
+                blacklist = set()
+                if indexes.get(system["catver"]) is not None:
+                    blacklist = indexes[system["catver"]].roms_in(
+                        system["exclude_categories"])
+                filters.append((whitelists.get(system["whitelist"]),
+                                blacklist))
+            future = pool.submit(run_group, group, filters,
+                                 rules.get(group[0]["rules"]), do_copy, jobs,
+                                 full)
+            futures[future] = ", ".join(system["name"] for system in group)
+        for future in as_completed(futures):
+            print(f"== {futures[future]} ==")
+            try:
+                output, group_results = future.result()
+            except Exception as error:
+                # Don't let one system take the others' output down with it
+                print(f"ERROR: {futures[future]} failed: {error}\n")
+                continue
+            results.update(group_results)
+            print(output)
+
+    print("Summary")
+    totals = dict.fromkeys(next(iter(results.values()), {}), 0)
+    for system in systems:
+        result = results.get(system["name"])
+        if result is None:
+            print(f"{system['name']}: failed")
+            continue
+        for key in totals:
+            totals[key] += result[key]
+        print(f"{system['name']}: {format_result(result)}")
+    if results:
+        print(f"Total: {format_result(totals)}")
+
+
+def format_result(result):
+    """One line description of what copy_roms did"""
+    return (f"{result['picked']} picked, {result['copied']} copied, "
+            f"{result['up_to_date'] + result['unchanged']} up to date, "
+            f"{result['removed']} removed, {result['failed']} failed, "
+            f"{result['bytes'] / 1e6:.1f} MB")
 
 
 def parse_args():
     """Parse arguments"""
     parser = argparse.ArgumentParser(
         description="Cleans up roms by making a single copy")
-    parser.add_argument("source", help="Source directory")
-    parser.add_argument("destination", help="Target directory")
+    parser.add_argument("source", help="Source directory", nargs="?")
+    parser.add_argument("destination", help="Target directory", nargs="?")
+    parser.add_argument(
+        "--config",
+        help="Ini file listing several systems to run instead of source and destination",
+        default=None)
+    parser.add_argument(
+        "--processes",
+        help="With --config, how many systems to run at once",
+        type=int,
+        default=None)
     parser.add_argument("--extension",
                         help="File extension to match",
                         default="zip")
@@ -231,9 +920,10 @@ def parse_args():
     parser.add_argument("--ignore",
                         help="Pattern of filenames to ignore",
                         default=r"^\[")
-    parser.add_argument("--action",
-                        default="link",
-                        help="What to do {link,copy,clean}")
+    parser.add_argument(
+        "--action",
+        default="link",
+        help="What to do {link,hardlink,reflink,copy,clean}")
     parser.add_argument(
         "--whitelist",
         help="Only keeps the games found in the specified document",
@@ -241,13 +931,38 @@ def parse_args():
     parser.add_argument("--catver",
                         help="Path to catver.ini file",
                         default=DEFAULT_CATVER)
+    parser.add_argument(
+        "--full",
+        help="Look at every game again, ignoring the last run's manifest",
+        default=False,
+        action="store_true")
+    parser.add_argument("--rules",
+                        help="Ini file with the rules for picking roms",
+                        default=None)
+    parser.add_argument(
+        "--check-rules",
+        help="Compare the rules' picks with the original rules and exit",
+        default=False,
+        action="store_true")
+    parser.add_argument("--jobs",
+                        help="Number of file operations to run at once",
+                        type=int,
+                        default=fsio.DEFAULT_JOBS)
     parser.add_argument("--exclude-categories",
                         help="Categories to exclude",
                         default=None,
                         nargs="+")
     args = parser.parse_args()
-    if args.action not in ["link", "copy", "clean"]:
-        print("--action must be link or copy or clean")
+    if args.check_rules:
+        return args
+
+    if args.config is None and (args.source is None
+                                or args.destination is None):
+        print("source and destination are required (or use --config)")
+        return None
+
+    if args.action not in fsio.TRANSFER_ACTIONS + ("clean", ):
+        print("--action must be link, hardlink, reflink, copy or clean")
         return None
 
     if args.exclude_categories is None:
@@ -259,28 +974,30 @@ def parse_args():
 def main():
     """Main Method"""
     args = parse_args()
-    if args:
+    if args and args.check_rules:
+        check_rules(RomRanker(read_rules(args.rules) if args.rules else None))
+    elif args and args.config:
+        run_batch(read_config(args.config), args.run, args.jobs,
+                  args.processes, args.full)
+    elif args:
         whitelist = None
         if args.whitelist:
             whitelist = read_filter(args.whitelist)
 
-        categories = {}
-        if args.catver:
-            categories = read_catver(args.catver)
-
-        blacklist = []
-        if args.exclude_categories:
-            for rom, categories in categories.items():
-                if any([
-                        category in args.exclude_categories
-                        for category in categories
-                ]):
-                    blacklist.append(rom)
+        blacklist = set()
+        if args.catver and args.exclude_categories:
+            if os.path.exists(args.catver):
+                index = CategoryIndex.read(args.catver)
+                blacklist = index.roms_in(args.exclude_categories)
+            else:
+                print(f"Could not find {args.catver}, not excluding categories")
         print(f"Blacklisted {len(blacklist)} games")
 
+        ranker = RomRanker(read_rules(args.rules) if args.rules else None)
+
         copy_roms(args.source, args.ignore, args.destination, args.extension,
                   args.action, args.run, args.show_failure, whitelist,
-                  blacklist)
+                  blacklist, args.jobs, ranker, args.full)
     else:
         print("run with --help for usage")
 
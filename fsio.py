@@ -0,0 +1,258 @@
+"""Batched filesystem access for roms that live on a network share
+
+Every stat, directory listing or copy on an SMB/NFS mount is a round trip to
+the server. The helpers here run batches of those calls on a thread pool so
+their latency overlaps instead of adding up.
+"""
+import fcntl
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from shutil import copyfile
+
+# Threads mostly wait on the network, so use more than there are CPUs
+DEFAULT_JOBS = 16
+
+# ioctl that makes a copy-on-write clone of a file (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Ways transfer_many can put a file at its target
+TRANSFER_ACTIONS = ("link", "hardlink", "reflink", "copy")
+
+
+def reflink(source, target):
+    """Makes target a copy-on-write clone of source"""
+    with open(source, "rb") as source_handle, open(target,
+                                                   "wb") as target_handle:
+        fcntl.ioctl(target_handle.fileno(), FICLONE, source_handle.fileno())
+
+
+def fast_copy(source, target):
+    """Copies source to target in the kernel when possible
+
+    Raises OSError if target doesn't end up the size source was.
+    """
+    size = os.stat(source).st_size
+    remaining = size
+    try:
+        with open(source, "rb") as source_handle, open(target,
+                                                       "wb") as target_handle:
+            while remaining > 0:
+                copied = os.copy_file_range(source_handle.fileno(),
+                                            target_handle.fileno(),
+                                            min(remaining, 1 << 30))
+                if copied == 0:
+                    break
+                remaining -= copied
+    except (AttributeError, OSError):
+        # Old kernel or python, or a filesystem that doesn't support it
+        remaining = size
+    if remaining > 0:
+        # Also when copy_file_range stopped short, which some filesystems do
+        copyfile(source, target)
+        if os.path.getsize(target) != size:
+            raise OSError(f"Copied {os.path.getsize(target)} of {size} bytes")
+
+
+def transfer(source, target, action):
+    """Puts source at target, returns the bytes transferred or None if skipped
+
+    Targets that already match (same size and mtime for copies, the same
+    file for hardlinks, anything for symlinks) are left alone.
+    """
+    source_stat = os.stat(source)
+    try:
+        target_stat = os.lstat(target)
+    except OSError:
+        target_stat = None
+
+    if target_stat is not None:
+        if action == "link":
+            return None
+        if action == "hardlink" and os.path.samestat(source_stat,
+                                                     target_stat):
+            return None
+        if action in ("copy", "reflink") and (
+                target_stat.st_size == source_stat.st_size
+                and target_stat.st_mtime_ns == source_stat.st_mtime_ns):
+            return None
+
+    if action == "link":
+        os.symlink(source, target)
+        return 0
+
+    # Write next to the target and swap it in, so a failure never leaves a
+    # partial file behind
+    temp_path = f"{target}.partial"
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    try:
+        if action == "hardlink":
+            os.link(source, temp_path)
+        elif action == "reflink":
+            reflink(source, temp_path)
+        elif action == "copy":
+            fast_copy(source, temp_path)
+        else:
+            raise RuntimeError(f"Unknown action {action}")
+        if action != "hardlink":
+            os.utime(temp_path,
+                     ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        os.replace(temp_path, target)
+    except OSError:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
+    # Links don't move any data
+    return 0 if action == "hardlink" else source_stat.st_size
+
+
+def iter_files(directory, extensions=None):
+    """Yields the paths of the files in directory as scandir finds them
+
+    Hidden files are skipped, like glob does. If `extensions` is given only
+    files ending in one of them (without the dot) are listed.
+    """
+    suffixes = None
+    if extensions:
+        suffixes = tuple(f".{extension}" for extension in extensions)
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if suffixes is not None and not entry.name.endswith(suffixes):
+                continue
+            if entry.is_file():
+                yield entry.path
+
+
+class FileSystem:
+    """Runs batches of filesystem calls on a shared thread pool"""
+    def __init__(self, jobs=DEFAULT_JOBS, throttle=None):
+        """Constructor
+
+        If given, `throttle` is called (with no arguments) before each call,
+        and can sleep to slow things down.
+        """
+        self._jobs = jobs or DEFAULT_JOBS
+        self._throttle = throttle
+        self._pool = None
+        # Number of filesystem calls made, for reporting
+        self.calls = 0
+        self.stats = 0
+
+    @property
+    def pool(self):
+        """The thread pool, started on first use"""
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self._jobs)
+        return self._pool
+
+    def map(self, function, items):
+        """Returns [function(item) for item in items], run on the pool"""
+        items = list(items)
+        self.calls += len(items)
+        if self._throttle is not None:
+            function = self._throttled(function)
+        if len(items) <= 1 or self._jobs <= 1:
+            return [function(item) for item in items]
+        return list(self.pool.map(function, items))
+
+    def _throttled(self, function):
+        """Returns function, calling the throttle first"""
+        def throttled(item):
+            self._throttle()
+            return function(item)
+
+        return throttled
+
+    def close(self):
+        """Stops the worker threads"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def stat_many(self, paths):
+        """Returns a dictionary of path to os.stat result (None if missing)"""
+        def try_stat(path):
+            try:
+                return os.stat(path)
+            except OSError:
+                return None
+
+        paths = list(dict.fromkeys(paths))
+        self.stats += len(paths)
+        return dict(zip(paths, self.map(try_stat, paths)))
+
+    def exists_many(self, paths):
+        """Returns a dictionary of path to whether it exists"""
+        return {
+            path: stat is not None
+            for path, stat in self.stat_many(paths).items()
+        }
+
+    def list_many(self, directories, extensions=None):
+        """Returns a dictionary of directory to the sorted files inside it
+
+        See `iter_files` for which files are listed.
+        """
+        def list_directory(directory):
+            try:
+                return sorted(iter_files(directory, extensions))
+            except OSError:
+                return []
+
+        directories = list(dict.fromkeys(directories))
+        return dict(zip(directories, self.map(list_directory, directories)))
+
+    def remove_many(self, paths, missing_ok=False):
+        """Deletes each path"""
+        def remove(path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                if not missing_ok:
+                    raise
+
+        self.map(remove, paths)
+
+    def transfer_many(self, pairs, action, progress_interval=5):
+        """Transfers each (source, target) pair, see `transfer`
+
+        Prints progress every `progress_interval` seconds and returns a
+        summary dictionary, with the pairs that failed under "failed".
+        """
+        pairs = list(pairs)
+        self.calls += len(pairs)
+        summary = {"files": 0, "skipped": 0, "failed": [], "bytes": 0}
+        start = last_report = time.monotonic()
+        futures = {
+            self.pool.submit(transfer, source, target, action):
+            (source, target)
+            for source, target in pairs
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                transferred = future.result()
+            except OSError as error:
+                summary["failed"].append(futures[future])
+                print(f"ERROR: {action} {futures[future][0]} failed: {error}")
+                continue
+            if transferred is None:
+                summary["skipped"] += 1
+            else:
+                summary["files"] += 1
+                summary["bytes"] += transferred
+            now = time.monotonic()
+            if now - last_report >= progress_interval:
+                last_report = now
+                print(f"{done}/{len(pairs)} files, "
+                      f"{format_rate(summary['bytes'], now - start)}")
+        summary["seconds"] = time.monotonic() - start
+        return summary
+
+
+def format_rate(byte_count, seconds):
+    """Returns a human readable amount of data and throughput"""
+    rate = byte_count / seconds if seconds > 0 else 0
+    return f"{byte_count / 1e6:.1f} MB at {rate / 1e6:.1f} MB/s"
@@ -1,7 +1,6 @@
 """Supports cleaning gamelist.xml files, and keeping a separate easy to edit list of favorites and kidgames"""
 import argparse
 import os.path
-import xml.etree.ElementTree as ET
 import json
 import os
 import glob
@@ -10,6 +9,25 @@ import signal
 import sys
 from shutil import copyfile
 import re
+import difflib
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import time
+import background
+import changelog
+import fsio
+import metrics
+import romindex
+import romtags
+import videoprobe
+import xmltree
+from xmltree import ET
+
+try:
+    from PIL import Image
+except ImportError:
+    # Only needed for optimize-images
+    Image = None
 
 DEFAULT_GAMELIST_DIRS = (os.path.expanduser("~/RetroPie/roms"),
                          os.path.expanduser("~/.emulationstation/gamelists"))
@@ -22,9 +40,203 @@ DEFAULT_KIDLIST_PATH = os.path.expanduser(
 DEFAULT_FORMAT_CACHE = os.path.expanduser(
     os.path.expanduser("~/.emulationstation/format_cache.json"))
 
+DEFAULT_IMAGE_CACHE = os.path.expanduser(
+    "~/.emulationstation/image_cache.json")
+
+DEFAULT_SLIM_DIR = os.path.expanduser("~/.emulationstation/gamelists-slim")
+
+# Kept by export-slim, everything else scrapers add is dropped
+SLIM_FIELDS = ("path", "name", "desc", "image", "video", "marquee",
+               "thumbnail", "rating", "releasedate", "developer", "publisher",
+               "genre", "players", "favorite", "kidgame", "playcount",
+               "lastplayed")
+
+# Fields holding paths relative to the gamelist's folder. export-slim makes
+# them absolute, so the slim gamelist can live anywhere
+PATH_FIELDS = ("path", "image", "video", "marquee", "thumbnail")
+
+# How alike (0 to 1) two titles must be for find-duplicates
+DEFAULT_SIMILARITY = 0.85
+
+# Characters of description kept by export-slim
+DEFAULT_SLIM_DESCRIPTION = 300
+
+# Longest side, in pixels, that images are downscaled to
+DEFAULT_MAX_IMAGE_SIZE = 800
+
+# Named transcode targets for format-videos. A video is only left alone if it
+# matches every setting of its profile
+VIDEO_PROFILES = {
+    # Only fixes the pixel format, which OMX player needs
+    "pixfmt": {
+        "pix_fmt": "yuv420p"
+    },
+    "pi3": {
+        "codec": "h264",
+        "pix_fmt": "yuv420p",
+        "max_width": 640,
+        "max_height": 480,
+        "max_bitrate": 1000000,
+        "audio_channels": 2
+    },
+    "pi-zero": {
+        "codec": "h264",
+        "pix_fmt": "yuv420p",
+        "max_width": 320,
+        "max_height": 240,
+        "max_bitrate": 500000,
+        "audio_channels": 1
+    },
+}
+
+DEFAULT_VIDEO_PROFILE = "pixfmt"
+
+# How far over max_bitrate a video may be and still match its profile, since
+# the encoder's rate control only keeps close to the cap
+VIDEO_BITRATE_TOLERANCE = 1.1
+
+# Allowance for audio and container overhead when only the bitrate of the
+# whole file is known (MKV, or ffprobe without a stream bitrate)
+AUDIO_BITRATE_ALLOWANCE = 192000
+
+# ffmpeg encoders for the codec names that ffprobe reports
+VIDEO_ENCODERS = {"h264": "libx264", "hevc": "libx265", "mpeg4": "mpeg4"}
+
 TEXT_REPLACEMENTS = (("&amp;", "&"), ("&quot;", "\""), ("&copy;", "©"),
                      ("&nbsp;", " "), ("&#039;", "&apos;"))
 
+# Fields clean-media treats as media, and the files it will remove
+MEDIA_FIELDS = ("image", "video", "marquee")
+# Compared against the lower-cased extension, so FOO.PNG counts too
+MEDIA_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp", ".mp4",
+                    ".mkv", ".avi", ".mov", ".webm"}
+
+# Bytes read from the start of a file for a quick comparison
+PARTIAL_HASH_SIZE = 64 * 1024
+
+# Fields whose text is normalized by `clean`
+DEFAULT_TEXT_FIELDS = ("desc", "developer", "publisher")
+
+# Written by --metrics, as (name, type, help)
+METRIC_DESCRIPTIONS = (
+    ("action_duration_seconds", "gauge",
+     "Time taken by the action, including saving"),
+    ("save_duration_seconds", "gauge",
+     "Time taken backing up and saving changed files"),
+    ("games", "gauge", "Games in each system's gamelist"),
+    ("filesystem_calls_total", "counter",
+     "Batched stat, listing, remove and copy calls"),
+    ("stat_calls_total", "counter", "Files statted"),
+    ("subprocesses_total", "counter", "ffmpeg and ffprobe runs"),
+    ("bytes_written_total", "counter",
+     "Bytes written by saving and backing up lists"),
+    ("format_cache_hits_total", "counter",
+     "Videos whose format was found in the format cache"),
+    ("format_cache_misses_total", "counter",
+     "Videos that had to be probed"),
+    ("last_run_timestamp_seconds", "gauge", "When the run finished"),
+)
+
+_TEXT_REPLACEMENT_MAP = dict(TEXT_REPLACEMENTS)
+_TEXT_REPLACEMENT_PATTERN = re.compile("|".join(
+    re.escape(old) for old, _ in TEXT_REPLACEMENTS))
+
+
+def clean_text(text):
+    """Applies all of TEXT_REPLACEMENTS to text using a single compiled pattern"""
+    while True:
+        # Repeat only while something changed, so "&amp;quot;" still ends up
+        # as a quote like it did when the replacements were chained
+        cleaned = _TEXT_REPLACEMENT_PATTERN.sub(
+            lambda match: _TEXT_REPLACEMENT_MAP[match.group(0)], text)
+        if cleaned == text:
+            return cleaned
+        text = cleaned
+
+
+def truncate_text(text, length):
+    """Shortens text to at most `length` characters, ending on a whole word"""
+    if len(text) <= length:
+        return text
+    cut = text[:length - 1]
+    if " " in cut:
+        cut = cut.rsplit(" ", 1)[0]
+    return cut.rstrip(" ,.;:") + "…"
+
+
+def probe_video(path):
+    """Returns the properties of a video that transcode profiles care about
+
+    The container headers are read directly when possible, ffprobe is only
+    started for formats videoprobe doesn't understand.
+    """
+    info = videoprobe.probe(path)
+    if info is not None:
+        return info
+    return ffprobe_video(path)
+
+
+def ffprobe_video(path):
+    """Same as probe_video, but always runs ffprobe"""
+    metrics.registry.add("subprocesses_total", command="ffprobe")
+    probe = ffmpeg.probe(path)
+    video_stream = next((stream for stream in probe["streams"]
+                         if stream["codec_type"] == "video"), None)
+    if video_stream is None:
+        return None
+    audio_stream = next((stream for stream in probe["streams"]
+                         if stream["codec_type"] == "audio"), None)
+    container = probe.get("format", {})
+    return {
+        "codec": video_stream.get("codec_name"),
+        "pix_fmt": video_stream.get("pix_fmt"),
+        "width": int(video_stream.get("width", 0)),
+        "height": int(video_stream.get("height", 0)),
+        "bit_rate": int(
+            video_stream.get("bit_rate") or container.get("bit_rate") or 0),
+        "total_bit_rate": not video_stream.get("bit_rate"),
+        "audio_channels":
+        int(audio_stream.get("channels", 0)) if audio_stream else 0,
+        "duration": float(container.get("duration") or 0),
+        "size": os.path.getsize(path),
+    }
+
+
+def video_matches_profile(info, profile):
+    """Whether a probed video already satisfies every part of the profile"""
+    if info is None:
+        return False
+    for key in ("codec", "pix_fmt"):
+        if key in profile and info[key] != profile[key]:
+            return False
+    for key, limit in (("width", "max_width"), ("height", "max_height"),
+                       ("audio_channels", "audio_channels")):
+        if limit in profile and info[key] > profile[limit]:
+            return False
+    if "max_bitrate" in profile:
+        max_bitrate = profile["max_bitrate"] * VIDEO_BITRATE_TOLERANCE
+        if info.get("total_bit_rate"):
+            max_bitrate += AUDIO_BITRATE_ALLOWANCE
+        if info["bit_rate"] > max_bitrate:
+            return False
+    return True
+
+
+def expected_video_saving(info, profile):
+    """Estimates how many bytes transcoding to profile would save"""
+    if info is None or not info["bit_rate"] or not info["duration"]:
+        return 0
+    bit_rate = info["bit_rate"]
+    if "max_bitrate" in profile:
+        bit_rate = min(bit_rate, profile["max_bitrate"])
+    width, height = info["width"], info["height"]
+    if width and height and ("max_width" in profile
+                             or "max_height" in profile):
+        scale = min(1, profile.get("max_width", width) / width,
+                    profile.get("max_height", height) / height)
+        bit_rate = min(bit_rate, info["bit_rate"] * scale * scale)
+    return max(0, int(info["size"] - bit_rate * info["duration"] / 8))
+
 
 class Game:
     """Represents a single game of a system"""
@@ -83,16 +295,7 @@ class Game:
     @property
     def tags(self):
         """Returns the tags present in the games path"""
-        paren_start = self.name.find(" (")
-
-        tags = []
-        if paren_start > 0:
-            # Split all the tokens at commas
-            tokens = re.findall(r"\(([^/)]+)\)", self.name)
-            for token in tokens:
-                for t in token.split(","):
-                    tags.append(t.strip())
-        return tags
+        return romtags.parse_name(self.name).tags
 
 
 class KidlistGame(Game):
@@ -116,10 +319,16 @@ class KidlistGame(Game):
         token_list = self.system.get_list(token)
         if value:
             token_list.append(self.name)
-            self.system.add_change(f"Marked {self.name} as {token}")
+            self.system.add_change(f"Marked {self.name} as {token}",
+                                   change_type="marked",
+                                   game=self.name,
+                                   field=token)
         else:
             token_list.remove(self.name)
-            self.system.add_change(f"Marked {self.name} as not {token}")
+            self.system.add_change(f"Marked {self.name} as not {token}",
+                                   change_type="unmarked",
+                                   game=self.name,
+                                   field=token)
 
 
 class GamelistGame(Game):
@@ -151,15 +360,20 @@ class GamelistGame(Game):
         if value:
             kidgame = ET.SubElement(self._element, token)
             kidgame.text = "true"
-            self.add_change(f"Marked {self.display_name} as {token}")
+            self.add_change(f"Marked {self.display_name} as {token}",
+                            change_type="marked",
+                            field=token)
         else:
             sub_element = self._element.find(token)
             self._element.remove(sub_element)
-            self.add_change(f"Marked {self.display_name} as not {token}")
+            self.add_change(f"Marked {self.display_name} as not {token}",
+                            change_type="unmarked",
+                            field=token)
 
-    def add_change(self, change, notice=False):
-        """Adds a change to the list"""
-        self.system.add_change(change, notice)
+    def add_change(self, change, notice=False, change_type="changed",
+                   field=None):
+        """Adds a change about this game to the log"""
+        self.system.add_change(change, notice, change_type, self.name, field)
 
     def get_property(self, token, default=None, escaped=False):
         """Returns the value of a token, or the default if it's not found"""
@@ -234,14 +448,13 @@ class GamelistGame(Game):
 
     @property
     def video_well_formatted(self):
-        """Whether the video is properly formatted"""
+        """Whether the video matches the default transcode profile"""
         video_path = self.video
         if video_path and os.path.exists(video_path):
             try:
-                probe = ffmpeg.probe(video_path)
-                video_stream = next((stream for stream in probe['streams']
-                                     if stream['codec_type'] == 'video'), None)
-                return video_stream['pix_fmt'] in ['yuv420p']
+                return video_matches_profile(
+                    probe_video(video_path),
+                    VIDEO_PROFILES[DEFAULT_VIDEO_PROFILE])
             except ffmpeg._run.Error as error:
                 print(
                     f"Error probing {video_path} (video for {self.display_name})"
@@ -264,15 +477,35 @@ class GamelistGame(Game):
         return result
 
 
-    def format_video(self):
-        """Ensures the video is in a good format"""
+    def format_video(self, profile=None):
+        """Transcodes the video to match the profile"""
+        if profile is None:
+            profile = VIDEO_PROFILES[DEFAULT_VIDEO_PROFILE]
         video_path = self.video
         if video_path and os.path.exists(video_path):
             temp_path = "%s-new%s" % os.path.splitext(video_path)
+            options = {"pix_fmt": profile.get("pix_fmt", "yuv420p")}
+            if "codec" in profile:
+                options["vcodec"] = VIDEO_ENCODERS.get(profile["codec"],
+                                                       profile["codec"])
+            if "max_width" in profile or "max_height" in profile:
+                # Shrink to fit (never enlarge), keeping dimensions even
+                width = profile.get("max_width", "iw")
+                height = profile.get("max_height", "ih")
+                options["vf"] = (
+                    f"scale='min({width},iw)':'min({height},ih)'"
+                    ":force_original_aspect_ratio=decrease,"
+                    "scale=trunc(iw/2)*2:trunc(ih/2)*2")
+            if "max_bitrate" in profile:
+                options["maxrate"] = profile["max_bitrate"]
+                options["bufsize"] = 2 * profile["max_bitrate"]
+            if "audio_channels" in profile:
+                options["ac"] = profile["audio_channels"]
             print(f"Converting {video_path}")
+            metrics.registry.add("subprocesses_total", command="ffmpeg")
             try:
                 ffmpeg.input(video_path).output(
-                    temp_path, pix_fmt="yuv420p").overwrite_output().run(
+                    temp_path, **options).overwrite_output().run(
                         capture_stdout=True, capture_stderr=True)
                 os.rename(temp_path, video_path)
                 return True
@@ -288,7 +521,6 @@ class System:
     def __init__(self, name):
         """Constructor for a system"""
         self.name = name
-        self.changes = []
 
     def game(self, name):
         """Returns a game of the system"""
@@ -319,15 +551,52 @@ class SystemKidlist(System):
             self._dict[token] = []
         return self._dict[token]
 
-    def add_change(self, change, notice=False):
-        """Adds a change to the list"""
-        self._kidlist.add_change(self.name, change, notice)
+    def add_change(self,
+                   change,
+                   notice=False,
+                   change_type="changed",
+                   game=None,
+                   field=None):
+        """Adds a change to the log"""
+        self._kidlist.add_change(self.name, change, notice, change_type, game,
+                                 field)
 
     @property
     def hide_all(self):
         """Returns whether the full system is hidden"""
         return "hide_all" in self._dict and self._dict["hide_all"]
 
+    def flagged(self, token, names):
+        """Returns the set of names that have token set"""
+        if token == "hidden" and self.hide_all:
+            return set(names)
+        return set(self.get_list(token)) & set(names)
+
+    def set_flagged(self, token, names, wanted):
+        """Makes token set for the names in wanted, and unset for the rest"""
+        if token == "hidden" and self.hide_all:
+            # Everything is hidden anyway
+            return
+        token_list = self.get_list(token)
+        current = set(token_list)
+        to_add = sorted(set(wanted) - current)
+        to_remove = (current & set(names)) - set(wanted)
+        if to_remove:
+            token_list[:] = [
+                name for name in token_list if name not in to_remove
+            ]
+            for name in sorted(to_remove):
+                self.add_change(f"Marked {name} as not {token}",
+                                change_type="unmarked",
+                                game=name,
+                                field=token)
+        token_list.extend(to_add)
+        for name in to_add:
+            self.add_change(f"Marked {name} as {token}",
+                            change_type="marked",
+                            game=name,
+                            field=token)
+
     @property
     def games(self):
         """Returns an iterator of games represented by this system"""
@@ -354,15 +623,19 @@ class SystemKidlist(System):
                             changed = True
                 if changed:
                     self.add_change(
-                        f"Removed {game.name}, not found in gamelist")
+                        f"Removed {game.name}, not found in gamelist",
+                        change_type="removed",
+                        game=game.name)
 
 
 class Kidlist:
     """Class that keeps track of my own list of properties"""
-    def __init__(self, systems=None, path=DEFAULT_KIDLIST_PATH):
+    def __init__(self,
+                 systems=None,
+                 path=DEFAULT_KIDLIST_PATH,
+                 change_log=None):
         """Constructor"""
-        self.changes = {}
-        self.notices = {}
+        self.change_log = change_log or changelog.ChangeLog()
         self._path = path
         self._dict = {}
         self._systems_whitelist = systems
@@ -384,23 +657,51 @@ class Kidlist:
     def backup(self):
         """Backup"""
         copyfile(self._path, self.backup_path)
+        metrics.registry.add("bytes_written_total",
+                             os.path.getsize(self.backup_path),
+                             file="kidlist",
+                             operation="backup")
 
     def save(self):
         """Saves all changes"""
         # Save
         with open(self._path, "w") as handle:
             json.dump(self._dict, handle, indent=2, sort_keys=True)
+        metrics.registry.add("bytes_written_total",
+                             os.path.getsize(self._path),
+                             file="kidlist",
+                             operation="save")
 
     def restore_backup(self):
         """Restores from backup"""
         copyfile(self.backup_path, self._path)
 
-    def add_change(self, system, change, notice=False):
-        """Add a change to the list"""
-        working = self.notices if notice else self.changes
-        if system not in self.changes:
-            working[system] = []
-        working[system].append(change)
+    def add_change(self,
+                   system,
+                   change,
+                   notice=False,
+                   change_type="changed",
+                   game=None,
+                   field=None):
+        """Adds a change to the log"""
+        self.change_log.record("kidlist", system, change_type, change, game,
+                               field, notice)
+
+    @property
+    def changes(self):
+        """Returns the number of changes made to each system"""
+        return {
+            system: self.change_log.count("kidlist", system)
+            for system in self.change_log.systems("kidlist")
+        }
+
+    @property
+    def notices(self):
+        """Returns the number of notices about each system"""
+        return {
+            system: self.change_log.count("kidlist", system, notice=True)
+            for system in self.change_log.systems("kidlist", notice=True)
+        }
 
     @property
     def systems(self):
@@ -418,7 +719,8 @@ class Kidlist:
                 system_kidlist.clean(system_gamelist)
             else:
                 self.add_change(system_kidlist.name,
-                                "WARNING! No gamelist found!")
+                                "WARNING! No gamelist found!",
+                                change_type="missing")
 
 
 class SystemGamelist(System):
@@ -427,10 +729,9 @@ class SystemGamelist(System):
         """Constructor"""
         System.__init__(self, name)
         self._path = path
-        self._tree = ET.parse(self._path)
-        self.changes = []
-        self.notices = []
+        self._tree = xmltree.parse(self._path)
         self._gamelists = gamelists
+        metrics.registry.set("games", len(self._tree.getroot()), system=name)
 
     @property
     def backup_path(self):
@@ -444,20 +745,34 @@ class SystemGamelist(System):
     def backup(self):
         """Backup"""
         copyfile(self._path, self.backup_path)
+        metrics.registry.add("bytes_written_total",
+                             os.path.getsize(self.backup_path),
+                             file="gamelist",
+                             operation="backup",
+                             system=self.name)
 
     def save(self):
         """Saves any changes"""
-        self._tree.write(self._path, xml_declaration=True, encoding="UTF-8")
+        xmltree.write(self._tree, self._path)
         # Add a blank line
         with open(self._path, "a") as handle:
             handle.write("\n")
+        metrics.registry.add("bytes_written_total",
+                             os.path.getsize(self._path),
+                             file="gamelist",
+                             operation="save",
+                             system=self.name)
 
     @property
     def games(self):
         """Returns iterable list of games"""
         for rom in self._tree.getroot():
-            yield GamelistGame(rom, self,
-                               os.path.dirname(os.path.abspath(self._path)))
+            yield self._game(rom)
+
+    def _game(self, element):
+        """Returns the GamelistGame for an element of this gamelist"""
+        return GamelistGame(element, self,
+                            os.path.dirname(os.path.abspath(self._path)))
 
     def game(self, name):
         """Returns a specific game by its name"""
@@ -471,12 +786,38 @@ class SystemGamelist(System):
         name = GamelistGame.get_name_from_path(path)
         return self.game(name)
 
-    def add_change(self, change, notice=False):
-        """Adds a change to list of changes"""
-        if notice:
-            self.notices.append(change)
-        else:
-            self.changes.append(change)
+    def add_change(self,
+                   change,
+                   notice=False,
+                   change_type="changed",
+                   game=None,
+                   field=None):
+        """Adds a change to the log"""
+        self._gamelists.change_log.record("gamelist", self.name, change_type,
+                                          change, game, field, notice)
+
+    @property
+    def changes(self):
+        """Returns the number of changes made"""
+        return self._gamelists.change_log.count("gamelist", self.name)
+
+    @property
+    def notices(self):
+        """Returns the number of notices"""
+        return self._gamelists.change_log.count("gamelist",
+                                                self.name,
+                                                notice=True)
+
+    def flags(self, tokens=DEFAULT_TOKENS):
+        """Returns (game, set of tokens it has set) for each game
+
+        Each game's children are walked once, rather than once per token.
+        """
+        return [(game, {
+            child.tag
+            for child in game.element
+            if child.tag in tokens and child.text == "true"
+        }) for game in self.games]
 
     def remove_games(self, to_remove):
         """Removes games from this system"""
@@ -489,29 +830,63 @@ class SystemGamelist(System):
             change = f"Removed {game.display_name} ({game.name})"
             if comment is not None:
                 change = f"{change} - {comment}"
-            self.add_change(change)
+            self.add_change(change, change_type="removed", game=game.name)
+
+    @property
+    def directory(self):
+        """The folder the gamelist.xml is in"""
+        return os.path.dirname(os.path.abspath(self._path))
+
+    def media_paths(self, fields=MEDIA_FIELDS):
+        """Returns the set of absolute paths of the media games refer to"""
+        return {
+            os.path.abspath(os.path.join(self.directory, child.text))
+            for _, child in xmltree.select_children(self._tree.getroot(),
+                                                    fields) if child.text
+        }
+
+    @property
+    def fs(self):
+        """Batched filesystem access shared by all systems"""
+        return self._gamelists.fs
 
     def remove_incomplete(self, remove_empty=False):
         """Checks the files"""
         to_remove = set()
-        for game in self.games:
+        # One query for all the media instead of a find per game and field
+        root = self._tree.getroot()
+        relative = {}
+        for element, child in xmltree.select_children(root,
+                                                      ("video", "image")):
+            relative.setdefault((element, child.tag), child.text)
+        directory = os.path.dirname(os.path.abspath(self._path))
+        media = []
+        for element in root:
+            game = self._game(element)
             for field in ["video", "image"]:
-                path = game.get_path(field)
-                if not path:
-                    if remove_empty:
-                        to_remove.add((game, f"Empty {field}"))
-                elif not os.path.exists(path):
-                    to_remove.add((game, f"Missing {field}"))
+                path = relative.get((element, field))
+                if path:
+                    path = os.path.abspath(os.path.join(directory, path))
+                media.append((game, field, path))
+        exists = self.fs.exists_many(path for _, _, path in media if path)
+        for game, field, path in media:
+            if not path:
+                if remove_empty:
+                    to_remove.add((game, f"Empty {field}"))
+            elif not exists[path]:
+                to_remove.add((game, f"Missing {field}"))
 
         self.remove_games(to_remove)
 
-    def clean(self):
+    def clean(self, text_fields=DEFAULT_TEXT_FIELDS):
         """Clean the xml"""
         to_remove = set()
         paths = {}
         names = {}
-        for game in self.games:
-            if not game.exists:
+        games = [(game, game.path) for game in self.games]
+        exists = self.fs.exists_many(path for _, path in games)
+        for game, path in games:
+            if not exists[path]:
                 to_remove.add((game, "missing rom"))
                 continue
 
@@ -521,14 +896,13 @@ class SystemGamelist(System):
             names[game.display_name].append(game)
 
             # Check path
-            path = game.path
             if path in paths:
                 to_remove.add((game, "duplicate path"))
                 master = paths[path]._element
                 rom = game._element
                 # Merge attributes
                 master.attrib.update(rom.attrib)
-                for child in rom:
+                for child in list(rom):
                     if master.find(rom.tag) is None:
                         master.append(child)
                 continue
@@ -547,62 +921,203 @@ class SystemGamelist(System):
                 else:
                     paths = ", ".join([game.path for game in games])
                     self.add_change(
-                        f"Multiple games with name {name}: ({paths})", True)
+                        f"Multiple games with name {name}: ({paths})",
+                        True,
+                        change_type="duplicate",
+                        field="name")
 
         # Now remove the ones marked for removal
         self.remove_games(to_remove)
 
-        # Remove special characters
-        for game in self.games:
+        # Remove special characters and fix genres, selecting all the fields
+        # in one query
+        fields = {}
+        for element, child in xmltree.select_children(
+                self._tree.getroot(),
+                tuple(text_fields) + ("genre", )):
+            fields.setdefault(element, []).append(child)
+        for element, children in fields.items():
+            game = self._game(element)
             modified = False
-            for field in "desc", "developer", "developer":
-                description = game.get_property(field)
-                if description is not None:
-                    before = game.get_property(field, None, True)
-                    for replacement in TEXT_REPLACEMENTS:
-                        description = description.replace(*replacement)
-                    modified = modified or game.get_property(
-                        field, None, True) != before
+            for child in children:
+                if child.tag not in text_fields or not child.text:
+                    continue
+                text = clean_text(child.text)
+                if text != child.text:
+                    child.text = text
+                    modified = True
             if modified:
-                game.set_text_property(field, description)
-                self.add_change(f"Cleaned text of {game.name}")
+                game.add_change(f"Cleaned text of {game.name}",
+                                change_type="cleaned")
 
             if "Plateform" in game.genres:
                 game.set_text_property(
                     "genre",
                     game.get_property("genre").replace("Plateform",
                                                        "Platform"))
-                self.add_change(f"Cleaned genre of {game.name}")
+                game.add_change(f"Cleaned genre of {game.name}",
+                                change_type="cleaned",
+                                field="genre")
+
+    def merge_scrape(self, path, tokens=DEFAULT_TOKENS):
+        """Replaces this gamelist with a freshly scraped one at path
+
+        Games are matched by rom name in a single pass. Our tokens are kept
+        (and the scraper's dropped), as are any fields the scraper left out
+        or empty. Relative media paths in the new gamelist are rebased onto
+        this gamelist's folder. Rom paths are left as they are, the roms are
+        in this system's folder wherever the scrape was written.
+        """
+        new_root = xmltree.parse(path).getroot()
+        new_directory = os.path.dirname(os.path.abspath(path))
+        if new_directory != self.directory:
+            media_fields = [field for field in PATH_FIELDS if field != "path"]
+            for _, child in xmltree.select_children(new_root, media_fields):
+                child.text = self._rebase_path(child.text, new_directory)
+        old_games = {
+            GamelistGame.get_name_from_path(element.findtext("path")):
+            element
+            for element in self._tree.getroot()
+            if element.findtext("path")
+        }
 
-    def format_videos(self, dry_run, cache=None):
-        """Ensures all the videos for the roms are in a good format"""
-        if cache is None:
-            cache = {}
-        for game in self.games:
-            path = game.video
-            if path is None:
-                # No video for this one
+        added = changed = 0
+        for element in new_root:
+            rom_path = element.findtext("path")
+            old = old_games.pop(GamelistGame.get_name_from_path(rom_path),
+                                None) if rom_path else None
+            if old is None:
+                # The tokens are ours to set, not the scraper's
+                for child in list(element):
+                    if child.tag in tokens:
+                        element.remove(child)
+                added += 1
+                self.add_change(
+                    f"Added {element.findtext('name') or rom_path}",
+                    change_type="added",
+                    game=GamelistGame.get_name_from_path(rom_path)
+                    if rom_path else None)
                 continue
 
-            if cache is not None and path in cache:
-                if cache[path]:
+            before = [(child.tag, child.text) for child in old]
+            new_fields = {child.tag: child for child in element}
+            # Matched by rom name, so our path to the rom is the right one
+            new_fields["path"].text = old.findtext("path")
+            # Copied so moving children (lxml) doesn't disturb the loop
+            old = list(old)
+            # Ours are put back below, if we have them
+            for token in tokens:
+                if token in new_fields:
+                    element.remove(new_fields.pop(token))
+            for child in old:
+                current = new_fields.get(child.tag)
+                if current is None:
+                    element.append(child)
+                    new_fields[child.tag] = child
+                elif not (current.text or "").strip() and child.text:
+                    current.text = child.text
+            if sorted(before, key=str) != sorted(
+                ((child.tag, child.text) for child in element), key=str):
+                changed += 1
+
+        for name, element in old_games.items():
+            self.add_change(f"Removed {element.findtext('name')} ({name}), "
+                            "not in the new scrape",
+                            change_type="removed",
+                            game=name)
+        self._tree = ET.ElementTree(new_root)
+        self.add_change(
+            f"Merged {path}: {added} added, {len(old_games)} removed, "
+            f"{changed} changed",
+            change_type="merged")
+
+    def _rebase_path(self, text, directory):
+        """Returns a path relative to directory as one relative to ours
+
+        Paths outside our folder are made absolute, and absolute or home
+        relative paths are left alone.
+        """
+        if not text or os.path.isabs(text) or text.startswith("~"):
+            return text
+        absolute = os.path.normpath(os.path.join(directory, text))
+        relative = os.path.relpath(absolute, self.directory)
+        if relative.startswith(os.pardir):
+            return absolute
+        return f"./{relative}"
+
+    def export_slim(self,
+                    path,
+                    max_description=DEFAULT_SLIM_DESCRIPTION,
+                    fields=SLIM_FIELDS):
+        """Writes a smaller copy of this gamelist to path
+
+        Hidden games are left out, descriptions are truncated and only
+        `fields` are kept. Returns the number of games written.
+        """
+        root = ET.Element(self._tree.getroot().tag)
+        count = 0
+        for game in self.games:
+            if game.hidden:
+                continue
+            element = ET.SubElement(root, game.element.tag,
+                                    dict(game.element.attrib))
+            for child in game.element:
+                if child.tag not in fields or not child.text:
                     continue
-            else:
-                cache[path] = game.video_well_formatted
-            if not cache[path]:
-                self.add_change(f"Converted video for {game.display_name}")
-                if not dry_run:
-                    if game.format_video() and cache is not None:
-                        cache[path] = True
-
-            self._gamelists.save_cache()
+                text = child.text
+                if child.tag in PATH_FIELDS:
+                    text = game.get_path(child.tag)
+                elif child.tag == "desc":
+                    text = truncate_text(text, max_description)
+                ET.SubElement(element, child.tag).text = text
+            count += 1
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = "%s-new%s" % os.path.splitext(path)
+        xmltree.write(ET.ElementTree(root), temp_path)
+        os.replace(temp_path, path)
+        return count
+
+    def videos_to_format(self, profile_name):
+        """Returns (game, expected bytes saved) for videos not matching profile
+
+        Videos converted to the profile before, and not changed since, are
+        left alone even if they don't quite match it.
+        """
+        profile = VIDEO_PROFILES[profile_name]
+        videos = [(game, game.video) for game in self.games]
+        stats = self.fs.stat_many(path for _, path in videos if path)
+        # No video for these ones
+        videos = [(game, path) for game, path in videos
+                  if path and stats[path] is not None]
+
+        def video_info(video):
+            return self._gamelists.video_info(video[1], stats[video[1]])
+
+        infos = self.fs.map(video_info, videos)
+        result = []
+        for (game, path), info in zip(videos, infos):
+            if self._gamelists.converted_to(path) == profile_name:
+                continue
+            if not video_matches_profile(info, profile):
+                result.append((game, expected_video_saving(info, profile)))
+        return result
 
     def get_games_by_genre(self, genre):
         """Returns all the games in this system that have the given genre"""
-        return [
-            game for game in self.games
-            if genre.lower() in [g.lower() for g in game.genres]
-        ]
+        root = self._tree.getroot()
+        genres = {}
+        for element, child in xmltree.select_children(root, ("genre", )):
+            genres.setdefault(element, child.text)
+        genre = genre.lower()
+        result = []
+        for element in root:
+            text = genres.get(element)
+            # Same as GamelistGame.genres
+            game_genres = ["N/A"] if text is None else text.split(" / ")
+            if genre in [g.strip().lower() for g in game_genres]:
+                result.append(self._game(element))
+        return result
 
     def find_games(self, partial):
         """Returns all games that contain `partial`"""
@@ -616,9 +1131,9 @@ class SystemGamelist(System):
     @property
     def unscraped_games(self):
         """Returns all the games that are not in the gamelist"""
-        all_roms = glob.glob(os.path.join(os.path.dirname(self._path),
-                                          "*.zip"))
-        scraped_roms = [game.path for game in self.games]
+        directory = os.path.dirname(self._path)
+        all_roms = self.fs.list_many([directory], ["zip"])[directory]
+        scraped_roms = set(game.path for game in self.games)
         return filter(lambda rom: rom not in scraped_roms, all_roms)
 
 
@@ -627,8 +1142,12 @@ class Gamelists:
     def __init__(self,
                  systems=None,
                  dirs=DEFAULT_GAMELIST_DIRS,
-                 format_cache=DEFAULT_FORMAT_CACHE):
+                 format_cache=DEFAULT_FORMAT_CACHE,
+                 jobs=None,
+                 change_log=None):
         """Constructor"""
+        self.fs = fsio.FileSystem(jobs, background.checkpoint)
+        self.change_log = change_log or changelog.ChangeLog()
         self._dirs = dirs
         self._open_systems = {}
         self._systems_whitelist = systems
@@ -667,6 +1186,21 @@ class Gamelists:
                 path, system_name, self)
         return self._open_systems[system_name]
 
+    def add_file_change(self, change, change_type, path, system=None,
+                        notice=False):
+        """Logs a change to a file on disk (rom, media or export)"""
+        self.change_log.record("files", system or "all", change_type, change,
+                               field=path, notice=notice)
+
+    def with_all_systems(self):
+        """Returns these gamelists without the filter on systems"""
+        if not self._systems_whitelist:
+            return self
+        everything = Gamelists(None, self._dirs, self._format_cache_path,
+                               change_log=self.change_log)
+        everything.fs = self.fs
+        return everything
+
     def backup(self):
         """Backs-up all open systems"""
         for system in self._open_systems.values():
@@ -689,8 +1223,11 @@ class Gamelists:
             print(self._format_cache)
 
     @property
-    def systems(self):
-        """Returns an iterable list of systems"""
+    def gamelist_paths(self):
+        """Returns an iterable list of (system name, gamelist.xml path)
+
+        Unlike `systems`, nothing is parsed.
+        """
         for directory in self._dirs:
             for gamelist in glob.glob(
                     os.path.join(directory, "*", "gamelist.xml")):
@@ -698,16 +1235,24 @@ class Gamelists:
                 if os.path.islink(os.path.dirname(gamelist)):
                     # Ignore symlinks
                     continue
-                system = self.get_system_from_path(gamelist)
-                if system is None:
+                system_name = os.path.basename(
+                    os.path.dirname(os.path.abspath(gamelist)))
+                if self._systems_whitelist and system_name not in self._systems_whitelist:
                     continue
-                if self._systems_whitelist and system.name not in self._systems_whitelist:
-                    continue
-                yield system
+                yield system_name, gamelist
+
+    @property
+    def systems(self):
+        """Returns an iterable list of systems"""
+        for _, gamelist in self.gamelist_paths:
+            system = self.get_system_from_path(gamelist)
+            if system is None:
+                continue
+            yield system
 
     @property
     def changes(self):
-        """Returns a list of changes that were made"""
+        """Returns the number of changes made to each system"""
         changes = {}
         for system_name, system in self._open_systems.items():
             changes[system_name] = system.changes
@@ -721,16 +1266,129 @@ class Gamelists:
             for system in self._open_systems.values()
         }
 
-    def clean(self, ignore=("retropie")):
+    def clean(self, ignore=("retropie"), text_fields=DEFAULT_TEXT_FIELDS):
         """Does cleaning of the systems"""
         for system in self.systems:
             if system.name not in ignore:
-                system.clean()
+                system.clean(text_fields)
 
-    def format_videos(self, dry_run):
-        """Ensures the videos are formatted correctly"""
+    def video_info(self, path, stat=None):
+        """Returns the probed properties of a video, using the cache if possible"""
+        if stat is None:
+            fingerprint = romindex.fingerprint(path)
+        else:
+            fingerprint = [stat.st_size, stat.st_mtime_ns]
+        entry = self._format_cache.get(path)
+        if isinstance(entry, dict) and entry["fingerprint"] == fingerprint:
+            metrics.registry.add("format_cache_hits_total")
+            return entry["info"]
+        metrics.registry.add("format_cache_misses_total")
+        try:
+            info = probe_video(path)
+        except ffmpeg._run.Error as error:
+            print(f"Error probing {path}")
+            print(error)
+            info = None
+        self._format_cache[path] = {"fingerprint": fingerprint, "info": info}
+        return info
+
+    def converted_to(self, path):
+        """Returns the profile the video at path was converted to, or None
+
+        Only valid after video_info(path), which forgets the conversion if
+        the file changed since.
+        """
+        entry = self._format_cache.get(path)
+        return entry.get("converted_to") if isinstance(entry, dict) else None
+
+    def mark_converted(self, path, profile_name):
+        """Remembers that the video at path was just converted to a profile"""
+        self._format_cache.pop(path, None)
+        self.video_info(path)
+        self._format_cache[path]["converted_to"] = profile_name
+
+    def format_videos(self, dry_run, profiles=None, budget=None):
+        """Ensures the videos are formatted correctly
+
+        `profiles` maps system names to profile names, with None as the key
+        for the default. With a `budget`, only that many videos are converted,
+        starting with the ones expected to save the most space.
+        """
+        if profiles is None:
+            profiles = {}
+        todo = []
         for system in self.systems:
-            system.format_videos(dry_run, self._format_cache)
+            profile_name = profiles.get(system.name,
+                                        profiles.get(None,
+                                                     DEFAULT_VIDEO_PROFILE))
+            for game, saving in system.videos_to_format(profile_name):
+                todo.append((saving, game, profile_name))
+        self.save_cache()
+
+        if budget is not None:
+            todo.sort(key=lambda item: item[0], reverse=True)
+            todo = todo[:budget]
+
+        for saving, game, profile_name in todo:
+            if not dry_run:
+                background.checkpoint(os.path.getsize(game.video))
+                if not game.format_video(VIDEO_PROFILES[profile_name]):
+                    continue
+                # So it isn't converted again if it's still a bit off
+                self.mark_converted(game.video, profile_name)
+                self.save_cache()
+            game.add_change(
+                f"Converted video for {game.display_name} (~{saving} bytes saved)",
+                change_type="converted",
+                field="video")
+
+    def export_slim(self,
+                    directory=DEFAULT_SLIM_DIR,
+                    max_description=DEFAULT_SLIM_DESCRIPTION,
+                    dry_run=False):
+        """Writes slim copies of the gamelists to directory/<system>/
+
+        Only systems whose gamelist changed since the last export are
+        parsed and written again.
+        """
+        manifest_path = os.path.join(directory, ".export-slim.json")
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as handle:
+                manifest = json.load(handle)
+
+        exported = False
+        unchanged = 0
+        for system_name, path in self.gamelist_paths:
+            target = os.path.join(directory, system_name, "gamelist.xml")
+            entry = {
+                "fingerprint": romindex.fingerprint(path),
+                "max_description": max_description
+            }
+            if manifest.get(system_name) == entry and os.path.exists(target):
+                unchanged += 1
+                continue
+            system = self.get_system(system_name)
+            if system is None:
+                continue
+            if dry_run:
+                self.add_file_change(
+                    f"Would export {system_name} to {target}", "exported",
+                    target, system_name)
+                continue
+            count = system.export_slim(target, max_description)
+            manifest[system_name] = entry
+            exported = True
+            self.add_file_change(
+                f"Exported {count} {system_name} games to {target} "
+                f"({os.path.getsize(path)} -> {os.path.getsize(target)} bytes)",
+                "exported", target, system_name)
+
+        if exported:
+            with open(manifest_path, "w") as handle:
+                json.dump(manifest, handle, indent=2, sort_keys=True)
+        if unchanged:
+            print(f"{unchanged} systems unchanged since last export")
 
     def remove_incomplete(self, ignore=("retropie")):
         """Checks for missing images or videos"""
@@ -774,7 +1432,7 @@ def parse_args():
     parser.add_argument(
         "action",
         help=
-        "Action {sync,clean,info,format-videos,remove-incomplete,clean-kidlist,clean-roms,genres,genre}",
+        "Action {sync,clean,info,merge-scrape,export-slim,format-videos,optimize-images,dedupe-media,duplicate-roms,find-duplicates,remove-incomplete,clean-kidlist,clean-roms,clean-media,genres,genre}",
         default=["info"],
         nargs="*")
     parser.add_argument("--dry-run",
@@ -791,23 +1449,92 @@ def parse_args():
         "For `sync` action, set status only if both lists agree, otherwise unset (remove)",
         action="store_true",
         default=False)
+    parser.add_argument("--jobs",
+                        help="Number of files to work on at the same time",
+                        type=int,
+                        default=None)
+    parser.add_argument(
+        "--video-profile",
+        help=
+        f"For `format-videos`, transcode profile {{{','.join(VIDEO_PROFILES)}}}, or <system>=<profile> to pick one per system",
+        default=None,
+        nargs="+")
+    parser.add_argument(
+        "--budget",
+        help=
+        "For `format-videos`, only convert this many videos, largest savings first",
+        type=int,
+        default=None)
+    parser.add_argument(
+        "--max-image-size",
+        help="For `optimize-images`, longest side in pixels to downscale to",
+        type=int,
+        default=DEFAULT_MAX_IMAGE_SIZE)
+    parser.add_argument(
+        "--slim-dir",
+        help="For `export-slim`, where to write the slim gamelists",
+        default=DEFAULT_SLIM_DIR)
+    parser.add_argument(
+        "--max-description",
+        help="For `export-slim`, characters of each description to keep",
+        type=int,
+        default=DEFAULT_SLIM_DESCRIPTION)
+    parser.add_argument(
+        "--background",
+        help=
+        "Run at low CPU and disk priority, cap disk throughput, and pause while an emulator is running",
+        action="store_true",
+        default=False)
+    parser.add_argument(
+        "--background-rate",
+        help="With `--background`, disk throughput cap in MB/s (0 for none)",
+        type=float,
+        default=background.DEFAULT_RATE / 1e6)
+    parser.add_argument(
+        "--change-log",
+        help=
+        "Write each change as a line of JSON to this file instead of printing it",
+        default=None)
+    parser.add_argument(
+        "--max-changes",
+        help="Only show (or write) the details of this many changes",
+        type=int,
+        default=None)
+    parser.add_argument(
+        "--metrics",
+        help=
+        "Write run metrics to this file, as JSON if it ends in .json, otherwise in Prometheus textfile format",
+        default=None)
     args = parser.parse_args()
 
     return args
 
 
 def sync(kidlist, gamelists, union=True, tokens=DEFAULT_TOKENS):
-    """Syncs the two sources of truth"""
+    """Syncs the two sources of truth
+
+    For each system and token, the games that should be flagged are the
+    union (or intersection) of the games flagged in each list, and only the
+    games that differ from that are touched.
+    """
     for system in gamelists.systems:
         system_kidlist = kidlist.get_system(system.name)
-        for gamelist_game in system.games:
-            kidlist_game = system_kidlist.game(gamelist_game.name)
-            for token in tokens:
-                flagged_kidlist = kidlist_game.is_type(token)
-                flagged_gamelist = gamelist_game.is_type(token)
-                new_status = flagged_gamelist or flagged_kidlist if union else flagged_gamelist and flagged_kidlist
-                kidlist_game.set_type(token, new_status)
-                gamelist_game.set_type(token, new_status)
+        flags = system.flags(tokens)
+        names = {game.name for game, _ in flags}
+        for token in tokens:
+            flagged_gamelist = {
+                game.name
+                for game, game_flags in flags if token in game_flags
+            }
+            flagged_kidlist = system_kidlist.flagged(token, names)
+            if union:
+                wanted = flagged_gamelist | flagged_kidlist
+            else:
+                wanted = flagged_gamelist & flagged_kidlist
+            for game, game_flags in flags:
+                if (game.name in wanted) != (token in game_flags):
+                    game.set_type(token, game.name in wanted)
+            system_kidlist.set_flagged(token, names, wanted)
 
 
 def print_genres(gamelists, sort_by_count=True):
@@ -978,13 +1705,367 @@ def print_game_info(gamelists, arguments):
 def clean_roms(gamelists, dry_run):
     """Removes roms from disk that are not in the gamelist.xml"""
     print("Please wait...")
-    changes = []
+    to_remove = []
     for system in gamelists.systems:
         for game in system.unscraped_games:
-            changes.append(f"Removed {game} from disk")
+            gamelists.add_file_change(f"Removed {game} from disk", "deleted",
+                                      game, system.name)
+            to_remove.append(game)
+    if not dry_run:
+        gamelists.fs.remove_many(to_remove)
+
+
+def clean_media(gamelists, dry_run):
+    """Removes images, videos and marquees that no game refers to
+
+    Only folders that hold media of at least one game of the selected
+    systems are looked in, and never the rom folders themselves. Media used
+    by any system counts, even one that wasn't selected, since systems can
+    share a media folder.
+    """
+    selected = {system.name for system in gamelists.systems}
+    referenced = set()
+    # Media folder -> the first selected system using it, for the log
+    directories = {}
+    rom_directories = set()
+    for system in gamelists.with_all_systems().systems:
+        rom_directories.add(os.path.realpath(system.directory))
+        for path in system.media_paths():
+            # Compare by real folder, so symlinked media folders still match
+            directory = os.path.realpath(os.path.dirname(path))
+            referenced.add(os.path.join(directory, os.path.basename(path)))
+            if system.name in selected:
+                directories.setdefault(directory, system.name)
+    for directory in rom_directories:
+        directories.pop(directory, None)
+
+    listings = gamelists.fs.list_many(sorted(directories))
+    orphans = [
+        path for paths in listings.values() for path in paths
+        if os.path.splitext(path)[1].lower() in MEDIA_EXTENSIONS
+        and path not in referenced
+    ]
+    stats = gamelists.fs.stat_many(orphans)
+    for path in orphans:
+        gamelists.add_file_change(f"Removed {path}, not used by any game",
+                                  "deleted", path,
+                                  directories[os.path.dirname(path)])
+    if not dry_run:
+        gamelists.fs.remove_many(orphans, missing_ok=True)
+    if orphans:
+        freed = sum(stat.st_size for stat in stats.values() if stat)
+        print(f"{'Would free' if dry_run else 'Freed'} {freed} bytes")
+
+
+def parse_video_profiles(arguments):
+    """Parses `--video-profile` arguments of the form <profile> or <system>=<profile>"""
+    profiles = {}
+    for argument in arguments or []:
+        system_name, _, profile = argument.rpartition("=")
+        if profile not in VIDEO_PROFILES:
+            print(f"ERROR: Unknown video profile '{profile}' "
+                  f"(choose from {', '.join(VIDEO_PROFILES)})")
+            return None
+        profiles[system_name or None] = profile
+    return profiles
+
+
+def print_duplicate_roms(gamelists, cross_system=True):
+    """Prints roms with identical contents, even if they're named differently"""
+    index = romindex.RomIndex()
+    paths_by_system = {}
+    for system in gamelists.systems:
+        paths_by_system[system.name] = [
+            game.path for game in system.games if game.exists
+        ]
+    duplicates = romindex.find_duplicates(index, paths_by_system,
+                                          cross_system)
+    index.save()
+
+    underline("Duplicate roms")
+    for hits in duplicates:
+        for system_name, path in hits:
+            print(f"{system_name}: {path}")
+        print()
+    print(f"Found {len(duplicates)} roms with duplicate contents")
+
+
+def find_similar_games(gamelists,
+                       cross_system=False,
+                       threshold=DEFAULT_SIMILARITY):
+    """Returns lists of games whose titles are probably the same game
+
+    Games are split into blocks by romtags.blocking_key, and titles are only
+    compared within a block, so this stays close to linear.
+    """
+    blocks = {}
+    for system in gamelists.systems:
+        for game in system.games:
+            words = romtags.title_words(game.display_name or game.name)
+            if not words:
+                continue
+            key = romtags.blocking_key(words)
+            if not cross_system:
+                key = (system.name, ) + key
+            # Identical titles don't need comparing against each other
+            blocks.setdefault(key, {}).setdefault(" ".join(words),
+                                                  []).append(game)
+
+    groups = []
+    for titles in blocks.values():
+        # Merge titles that are similar enough, first match wins
+        merged = []
+        for title, games in titles.items():
+            for other in merged:
+                if difflib.SequenceMatcher(None, title,
+                                           other[0]).ratio() >= threshold:
+                    other[1].extend(games)
+                    break
+            else:
+                merged.append((title, list(games)))
+        groups.extend(games for _, games in merged if len(games) > 1)
+    return groups
+
+
+def print_similar_games(gamelists, cross_system=False):
+    """Prints games that look like duplicates of each other"""
+    groups = find_similar_games(gamelists, cross_system)
+    underline("Possible duplicates")
+    for games in groups:
+        for game in games:
+            print(f"{game.system.name}: {game.display_name} ({game.name})")
+        print()
+    print(f"Found {len(groups)} groups of possible duplicates")
+
+
+def hash_file(path, limit=None):
+    """Returns the sha1 of a file, or of its first `limit` bytes"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as handle:
+        if limit is not None:
+            background.checkpoint(limit)
+            digest.update(handle.read(limit))
+        else:
+            for chunk in iter(lambda: handle.read(1024 * 1024), b""):
+                background.checkpoint(len(chunk))
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def group_duplicates(groups, key, gamelists):
+    """Splits each group of paths by key(path), keeping groups of two or more
+
+    Paths that key fails to read are left out and logged as errors.
+    """
+    def try_key(path):
+        try:
+            return key(path), None
+        except OSError as error:
+            return None, error
+
+    paths = [path for group in groups for path in group]
+    values = {}
+    for path, (value, error) in zip(paths, gamelists.fs.map(try_key, paths)):
+        if error is not None:
+            gamelists.add_file_change(f"ERROR: Failed reading {path}: {error}",
+                                      "error",
+                                      path,
+                                      notice=True)
+        else:
+            values[path] = value
+    result = []
+    for group in groups:
+        split = {}
+        for path in group:
+            if path in values:
+                split.setdefault(values[path], []).append(path)
+        result.extend(hits for hits in split.values() if len(hits) > 1)
+    return result
+
+
+def dedupe_media(gamelists, dry_run):
+    """Replaces byte-identical images and videos with hardlinks
+
+    Stats and hashes run on the gamelists' FileSystem, so they're batched,
+    counted and throttled like every other action.
+    """
+    # Path -> the first system using it, for the log
+    paths = {}
+    for system in gamelists.systems:
+        for game in system.games:
+            for path in (game.image, game.video):
+                if path:
+                    paths.setdefault(os.path.realpath(path), system.name)
+
+    saved = 0
+    fs = gamelists.fs
+    # Only one path per inode, files that are already linked are done
+    by_inode = {}
+    for path, stat in fs.stat_many(sorted(paths)).items():
+        if stat is not None:
+            by_inode.setdefault((stat.st_dev, stat.st_ino), (path, stat))
+
+    # Hardlinks need the same filesystem, so that's part of the size key
+    by_size = {}
+    for path, stat in by_inode.values():
+        by_size.setdefault((stat.st_dev, stat.st_size), []).append(path)
+    sizes = {path: stat.st_size for path, stat in by_inode.values()}
+    groups = [group for group in by_size.values() if len(group) > 1]
+    groups = group_duplicates(
+        groups, lambda path: hash_file(path, PARTIAL_HASH_SIZE), gamelists)
+    # The partial hash already covered the whole of small files
+    small, large = [], []
+    for group in groups:
+        (small if sizes[group[0]] <= PARTIAL_HASH_SIZE else
+         large).append(group)
+    groups = small + group_duplicates(large, hash_file, gamelists)
+
+    for group in groups:
+        master, *duplicates = sorted(group)
+        for duplicate in duplicates:
             if not dry_run:
-                os.remove(game)
-    return changes
+                temp_path = f"{duplicate}.link"
+                try:
+                    os.link(master, temp_path)
+                    os.replace(temp_path, duplicate)
+                except OSError as error:
+                    # No hardlinks on FAT/exFAT, or across devices
+                    if os.path.lexists(temp_path):
+                        os.remove(temp_path)
+                    gamelists.add_file_change(
+                        f"ERROR: Failed linking {duplicate} to {master}: "
+                        f"{error}",
+                        "error",
+                        duplicate,
+                        paths[duplicate],
+                        notice=True)
+                    continue
+            gamelists.add_file_change(f"Linked {duplicate} to {master}",
+                                      "linked", duplicate, paths[duplicate])
+            saved += sizes[duplicate]
+    if saved:
+        print(f"{'Would free' if dry_run else 'Freed'} {saved} bytes")
+
+
+def optimize_image(path, max_size):
+    """Downscales the image at path so its longest side is at most max_size
+
+    Returns the (before, after) size in bytes, or None if it already fit or
+    is animated (saving would keep only the first frame).
+    """
+    before = os.path.getsize(path)
+    with Image.open(path) as image:
+        if max(image.size) <= max_size or getattr(image, "is_animated",
+                                                  False):
+            return None
+        image_format = image.format
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+        temp_path = "%s-new%s" % os.path.splitext(path)
+        options = {"optimize": True}
+        if image_format == "JPEG":
+            options["quality"] = 85
+        try:
+            image.save(temp_path, format=image_format, **options)
+        except Exception:
+            # Don't leave a half written image to be picked up as media
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+            raise
+    os.replace(temp_path, path)
+    return before, os.path.getsize(path)
+
+
+def _optimize_image_job(path, max_size):
+    """Runs optimize_image in a worker, returning errors instead of raising"""
+    try:
+        return optimize_image(path, max_size), None
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        return None, str(error)
+
+
+def optimize_images(gamelists,
+                    dry_run,
+                    max_size=DEFAULT_MAX_IMAGE_SIZE,
+                    jobs=None,
+                    cache_path=DEFAULT_IMAGE_CACHE):
+    """Downscales oversized images in a process pool"""
+    if Image is None:
+        print("ERROR: optimize-images needs Pillow (pip install Pillow)")
+        return
+
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as handle:
+            cache = json.load(handle)
+
+    # Path -> the first system using it, for the log
+    paths = {}
+    for system in gamelists.systems:
+        for game in system.games:
+            path = game.image
+            if path and os.path.exists(path):
+                paths.setdefault(os.path.realpath(path), system.name)
+
+    # Skip images known to be within budget that haven't changed since
+    todo = [
+        path for path in sorted(paths)
+        if cache.get(path) != romindex.fingerprint(path) + [max_size]
+    ]
+
+    if dry_run:
+        for path in todo:
+            try:
+                with Image.open(path) as image:
+                    width, height = image.size
+                    animated = getattr(image, "is_animated", False)
+            except (OSError, Image.DecompressionBombError) as error:
+                gamelists.add_file_change(
+                    f"ERROR: Failed reading {path}: {error}",
+                    "error",
+                    path,
+                    paths[path],
+                    notice=True)
+                continue
+            if max(width, height) > max_size and not animated:
+                gamelists.add_file_change(
+                    f"Would downscale {path} ({width}x{height})", "resized",
+                    path, paths[path])
+        return
+
+    saved = 0
+    with ProcessPoolExecutor(jobs) as pool:
+        results = pool.map(_optimize_image_job, todo,
+                           [max_size] * len(todo))
+        for path, (sizes, error) in zip(todo, results):
+            if error is not None:
+                gamelists.add_file_change(
+                    f"ERROR: Failed optimizing {path}: {error}",
+                    "error",
+                    path,
+                    paths[path],
+                    notice=True)
+                continue
+            if sizes is not None:
+                saved += sizes[0] - sizes[1]
+                gamelists.add_file_change(f"Downscaled {path}", "resized",
+                                          path, paths[path])
+            cache[path] = romindex.fingerprint(path) + [max_size]
+
+    with open(cache_path, "w") as handle:
+        json.dump(cache, handle, indent=2, sort_keys=True)
+    if saved:
+        print(f"Freed {saved} bytes")
+
+
+def write_metrics(path, gamelists):
+    """Writes the metrics collected during this run to path"""
+    registry = metrics.registry
+    for name, metric_type, help_text in METRIC_DESCRIPTIONS:
+        registry.describe(name, help_text, metric_type)
+    registry.set("filesystem_calls_total", gamelists.fs.calls)
+    registry.set("stat_calls_total", gamelists.fs.stats)
+    registry.set("last_run_timestamp_seconds", round(time.time()))
+    registry.write(path)
 
 
 def main():
@@ -994,11 +2075,28 @@ def main():
         print("use --help for usage")
         return
 
+    if args.background:
+        background.enable(int(args.background_rate * 1e6))
+        if args.jobs is None:
+            # One file at a time is gentler on an SD card
+            args.jobs = 1
+
+    change_log = changelog.ChangeLog(args.change_log, args.max_changes)
+
     # Load the two sources of truth
-    gamelists = Gamelists(args.systems)
-    kidlist = Kidlist(args.systems)
-    other_changes = []
+    gamelists = Gamelists(args.systems, jobs=args.jobs, change_log=change_log)
+    kidlist = Kidlist(args.systems, change_log=change_log)
 
+    with metrics.registry.timer("action_duration_seconds",
+                                action=args.action[0]):
+        run(args, gamelists, kidlist)
+    change_log.close()
+    if args.metrics:
+        write_metrics(args.metrics, gamelists)
+
+
+def run(args, gamelists, kidlist):
+    """Runs the action, then prints and saves the changes it made"""
     action, action_arguments = args.action[0], args.action[1:]
 
     if action == "sync":
@@ -1026,9 +2124,42 @@ def main():
     elif action == "clean-kidlist":
         kidlist.clean(gamelists)
     elif action == "clean-roms":
-        other_changes = clean_roms(gamelists, args.dry_run)
+        clean_roms(gamelists, args.dry_run)
+    elif action == "clean-media":
+        clean_media(gamelists, args.dry_run)
     elif action == "format-videos":
-        gamelists.format_videos(args.dry_run)
+        profiles = parse_video_profiles(args.video_profile)
+        if profiles is None:
+            return
+        gamelists.format_videos(args.dry_run, profiles, args.budget)
+    elif action == "merge-scrape":
+        if len(action_arguments) != 1:
+            print("ERROR: You must specify the new gamelist.xml")
+            return
+        if args.systems and len(args.systems) == 1:
+            system = gamelists.get_system(args.systems[0])
+        else:
+            system = gamelists.get_system_from_path(action_arguments[0])
+        if system is None:
+            print("ERROR: Could not tell which system to merge into, "
+                  "use --systems <system>")
+            return
+        system.merge_scrape(action_arguments[0])
+    elif action == "export-slim":
+        gamelists.export_slim(args.slim_dir, args.max_description,
+                              args.dry_run)
+    elif action == "dedupe-media":
+        dedupe_media(gamelists, args.dry_run)
+    elif action == "optimize-images":
+        optimize_images(gamelists, args.dry_run, args.max_image_size,
+                        args.jobs)
+    elif action == "duplicate-roms":
+        print_duplicate_roms(
+            gamelists, not action_arguments or action_arguments[0] != "within")
+    elif action == "find-duplicates":
+        print_similar_games(
+            gamelists, bool(action_arguments)
+            and action_arguments[0] == "across")
     elif action == "remove-incomplete":
         gamelists.remove_incomplete()
     elif action == "revert":
@@ -1045,34 +2176,25 @@ def main():
     else:
         print(f"Unknown action '{action}'")
 
-    if other_changes:
-        print(f"Changes:")
-        for change in other_changes:
-            print(change)
+    # The details were streamed as they happened, so just sum them up
+    summary = gamelists.change_log.summary()
+    if summary:
+        print()
+        underline("Summary")
+        for line in summary:
+            print(line)
+        print()
 
-    # Print any changes
     for source_type, source in {
             "kidlist": kidlist,
             "gamelist": gamelists
     }.items():
-        some_changes = False
-        for system, notices in source.notices.items():
-            if len(notices):
-                underline(f"Notices about {system}'s {source_type}")
-                for notice in notices:
-                    print(notice)
-
-        for system, changes in source.changes.items():
-            if len(changes):
-                underline(f"Changes to {system}'s {source_type}")
-                for change in changes:
-                    print(change)
-                    some_changes = True
-                print()
-        if some_changes:
+        if any(source.changes.values()):
             if not args.dry_run:
-                source.backup()
-                source.save()
+                with metrics.registry.timer("save_duration_seconds",
+                                            list=source_type):
+                    source.backup()
+                    source.save()
                 print(f"Saved {source_type} (backups made)")
             else:
                 print(f"Would have saved {source_type}")
@@ -0,0 +1,103 @@
+"""Counters and gauges for a run, written out as Prometheus text or JSON
+
+The Prometheus format is meant for node_exporter's textfile collector, so the
+file is replaced atomically and never seen half written.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """Named values, each split by a set of labels"""
+    def __init__(self, prefix=""):
+        """Constructor"""
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        # name -> {sorted label items: value}
+        self._values = {}
+        # name -> (type, help)
+        self._descriptions = {}
+
+    def describe(self, name, help_text, metric_type="gauge"):
+        """Sets the help text and type (gauge or counter) of a metric"""
+        self._descriptions[name] = (metric_type, help_text)
+
+    def add(self, name, value=1, **labels):
+        """Adds value to a metric"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Sets a metric to value"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values.setdefault(name, {})[key] = value
+
+    def get(self, name, **labels):
+        """Returns the value of a metric, or 0 if it was never set"""
+        return self._values.get(name, {}).get(tuple(sorted(labels.items())),
+                                              0)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Adds the seconds spent inside the `with` block to a metric"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start, **labels)
+
+    def to_dict(self):
+        """Returns {name: [{"labels": {...}, "value": value}]}"""
+        with self._lock:
+            return {
+                self._prefix + name: [{
+                    "labels": dict(key),
+                    "value": value
+                } for key, value in sorted(series.items())]
+                for name, series in sorted(self._values.items())
+            }
+
+    def to_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._values.items()):
+                full_name = self._prefix + name
+                metric_type, help_text = self._descriptions.get(
+                    name, ("gauge", None))
+                if help_text:
+                    lines.append(f"# HELP {full_name} {help_text}")
+                lines.append(f"# TYPE {full_name} {metric_type}")
+                for key, value in sorted(series.items()):
+                    labels = ",".join(f'{label}="{_escape(label_value)}"'
+                                      for label, label_value in key)
+                    labels = f"{{{labels}}}" if labels else ""
+                    lines.append(f"{full_name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Writes the metrics to path, as JSON if it ends in .json"""
+        if path.endswith(".json"):
+            text = json.dumps(self.to_dict(), indent=2) + "\n"
+        else:
+            text = self.to_prometheus()
+        temp_path = f"{path}.partial"
+        with open(temp_path, "w") as handle:
+            handle.write(text)
+        os.replace(temp_path, path)
+
+
+def _escape(value):
+    """Escapes a label value for the Prometheus text format"""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace(
+        '"', '\\"')
+
+
+# Shared by everything that runs as part of one kidgame.py invocation
+registry = Metrics("kidgame_")
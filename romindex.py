@@ -0,0 +1,167 @@
+"""Indexes the contents of roms without decompressing them
+
+Zipped roms are identified by the CRC32 and size of each member, read
+straight out of the zip central directory. Anything else is identified by
+the CRC32 of the whole file.
+"""
+import json
+import mmap
+import os
+import struct
+import zlib
+
+DEFAULT_INDEX_CACHE = os.path.expanduser(
+    "~/.emulationstation/rom_index.json")
+
+_EOCD = struct.Struct("<4s4H2LH")
+_EOCD_SIGNATURE = b"PK\x05\x06"
+_EOCD64_LOCATOR = struct.Struct("<4sLQL")
+_EOCD64_LOCATOR_SIGNATURE = b"PK\x06\x07"
+_EOCD64 = struct.Struct("<4sQ2H2L4Q")
+_EOCD64_SIGNATURE = b"PK\x06\x06"
+_CENTRAL_HEADER = struct.Struct("<4s6H3L5H2L")
+_CENTRAL_HEADER_SIGNATURE = b"PK\x01\x02"
+# The EOCD is at most this far from the end (record + maximum comment)
+_EOCD_SEARCH = _EOCD.size + 0xFFFF
+
+
+def fingerprint(path):
+    """Returns something that changes whenever the file at path does"""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _zip64_sizes(extra, sizes):
+    """Replaces any 0xFFFFFFFF entries of sizes from the zip64 extra field"""
+    position = 0
+    while position + 4 <= len(extra):
+        header_id, length = struct.unpack_from("<2H", extra, position)
+        position += 4
+        if header_id == 0x0001:
+            values = list(sizes)
+            field = position
+            for i, value in enumerate(values):
+                if value == 0xFFFFFFFF and field + 8 <= position + length:
+                    values[i] = struct.unpack_from("<Q", extra, field)[0]
+                    field += 8
+            return values
+        position += length
+    return sizes
+
+
+def _read_central_directory(data):
+    """Returns [name, crc, size] of each member listed in the zip in data"""
+    start = max(0, len(data) - _EOCD_SEARCH)
+    eocd = data.rfind(_EOCD_SIGNATURE, start)
+    if eocd < 0 or eocd + _EOCD.size > len(data):
+        return None
+    (_, _, _, _, count, cd_size,
+     cd_offset, _) = _EOCD.unpack_from(data, eocd)
+
+    locator = eocd - _EOCD64_LOCATOR.size
+    if locator >= 0 and data[locator:locator +
+                             4] == _EOCD64_LOCATOR_SIGNATURE:
+        eocd64 = _EOCD64_LOCATOR.unpack_from(data, locator)[2]
+        if data[eocd64:eocd64 + 4] == _EOCD64_SIGNATURE:
+            (_, _, _, _, _, _, _, count, cd_size,
+             cd_offset) = _EOCD64.unpack_from(data, eocd64)
+
+    members = []
+    position = cd_offset
+    for _ in range(count):
+        if data[position:position + 4] != _CENTRAL_HEADER_SIGNATURE:
+            return None
+        (_, _, _, flags, _, _, _, crc, compressed, size, name_length,
+         extra_length, comment_length, _, _, _,
+         _) = _CENTRAL_HEADER.unpack_from(data, position)
+        position += _CENTRAL_HEADER.size
+        name = bytes(data[position:position + name_length])
+        extra = bytes(data[position + name_length:position + name_length +
+                           extra_length])
+        position += name_length + extra_length + comment_length
+        size = _zip64_sizes(extra, (size, compressed))[0]
+        name = name.decode("utf-8" if flags & 0x800 else "cp437")
+        if name.endswith("/"):
+            # Directory entry
+            continue
+        members.append([name, crc, size])
+    return members
+
+
+def read_members(path):
+    """Returns [name, crc, size] of each file the rom at path contains"""
+    with open(path, "rb") as handle:
+        if os.fstat(handle.fileno()).st_size == 0:
+            return [[os.path.basename(path), 0, 0]]
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:4] == b"PK\x03\x04" or data[:4] == _EOCD_SIGNATURE:
+                try:
+                    members = _read_central_directory(data)
+                except struct.error:
+                    # Truncated or corrupt central directory
+                    members = None
+                if members is not None:
+                    return members
+            return [[os.path.basename(path), zlib.crc32(data), len(data)]]
+
+
+class RomIndex:
+    """Cache of rom contents keyed by path and file fingerprint"""
+    def __init__(self, cache_path=DEFAULT_INDEX_CACHE):
+        """Constructor"""
+        self._cache_path = cache_path
+        self._cache = {}
+        self._modified = False
+        self.hits = 0
+        self.misses = 0
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, "r") as handle:
+                self._cache = json.load(handle)
+
+    def members(self, path):
+        """Returns [name, crc, size] of each file in the rom at path"""
+        path = os.path.abspath(path)
+        current = fingerprint(path)
+        entry = self._cache.get(path)
+        if entry is not None and entry["fingerprint"] == current:
+            self.hits += 1
+            return entry["members"]
+        self.misses += 1
+        members = read_members(path)
+        self._cache[path] = {"fingerprint": current, "members": members}
+        self._modified = True
+        return members
+
+    def content_key(self, path):
+        """Returns a key that is equal for roms with the same contents"""
+        return tuple(
+            sorted((crc, size) for _, crc, size in self.members(path)))
+
+    def save(self):
+        """Writes the cache to disk if anything new was indexed"""
+        if not self._modified or not self._cache_path:
+            return
+        os.makedirs(os.path.dirname(self._cache_path) or ".", exist_ok=True)
+        with open(self._cache_path, "w") as handle:
+            json.dump(self._cache, handle)
+        self._modified = False
+
+
+def find_duplicates(index, paths_by_system, cross_system=True):
+    """Returns lists of (system, path) that share the same rom contents
+
+    If cross_system is False only duplicates inside the same system are
+    reported.
+    """
+    by_content = {}
+    for system, paths in paths_by_system.items():
+        for path in paths:
+            try:
+                key = index.content_key(path)
+            except (OSError, ValueError) as error:
+                print(f"Error indexing {path}: {error}")
+                continue
+            if not cross_system:
+                key = (system, key)
+            by_content.setdefault(key, []).append((system, path))
+    return [hits for hits in by_content.values() if len(hits) > 1]
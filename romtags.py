@@ -0,0 +1,155 @@
+"""Parses No-Intro style rom names like "Sonic (USA, Europe) (Rev 1).zip"
+
+Shared by copy_unique.py and kidgame.py. Results are memoized, so asking
+for the tags of the same rom again is a dictionary lookup.
+
+Run `python3 romtags.py [names.txt]` to benchmark parsing 100k names.
+"""
+import os.path
+import re
+import string
+import sys
+import time
+from collections import namedtuple
+from functools import lru_cache
+
+REGIONS = frozenset(
+    ("USA", "Europe", "Japan", "World", "Asia", "Australia", "Brazil",
+     "Canada", "China", "Denmark", "Finland", "France", "Germany", "Greece",
+     "Hong Kong", "India", "Ireland", "Italy", "Korea", "Mexico",
+     "Netherlands", "New Zealand", "Norway", "Poland", "Portugal", "Russia",
+     "Scandinavia", "Spain", "Sweden", "Taiwan", "UK", "Unknown"))
+
+# Parenthesised groups, except ones containing a "/"
+_TAG_GROUP = re.compile(r"\(([^/)]+)\)")
+_LANGUAGE = re.compile(r"^[A-Z][a-z](?:-[A-Z][a-z]+)?$")
+_REVISION = re.compile(r"^(?:Rev [0-9A-Z.]+|v[0-9][0-9.]*[a-z]?)$")
+
+_STANDARDIZE = str.maketrans("", "", string.punctuation)
+
+# Words dropped when comparing titles, wherever they are ("Legend of Zelda,
+# The" is the same game as "The Legend of Zelda")
+ARTICLES = frozenset(("the", "a", "an"))
+
+# Roman numerals that are read as sequel numbers. "i" and "x" are left
+# alone, they're too often a letter ("Mega Man X" isn't "Mega Man 10")
+ROMAN_NUMERALS = {
+    "ii": "2", "iii": "3", "iv": "4", "v": "5", "vi": "6", "vii": "7",
+    "viii": "8", "ix": "9", "xi": "11", "xii": "12", "xiii": "13",
+    "xiv": "14", "xv": "15", "xvi": "16", "xvii": "17", "xviii": "18",
+    "xix": "19", "xx": "20"
+}
+
+RomName = namedtuple("RomName",
+                     ("name", "tags", "regions", "languages", "revision",
+                      "flags"))
+RomName.__doc__ = """Parsed rom name
+
+name is standardized (lower case, no punctuation) so variants group
+together. tags holds every tag in order; regions, languages and flags split
+them up by kind, and revision is the "Rev 1" / "v1.1" tag if there is one.
+"""
+
+
+def standardize_name(name):
+    """Lower case, `&` as `and`, and no punctuation"""
+    return name.replace("&", "and").lower().translate(_STANDARDIZE)
+
+
+@lru_cache(maxsize=1 << 17)
+def parse_name(full_name):
+    """Returns the RomName for a rom name without its extension"""
+    paren_start = full_name.find(" (")
+    if paren_start <= 0:
+        return RomName(standardize_name(full_name), (), (), (), None, ())
+
+    tags = []
+    for group in _TAG_GROUP.findall(full_name):
+        # Split all the tokens at commas
+        tags.extend(tag.strip() for tag in group.split(","))
+
+    regions, languages, flags = [], [], []
+    revision = None
+    for tag in tags:
+        if tag in REGIONS:
+            regions.append(tag)
+        elif _LANGUAGE.match(tag):
+            languages.append(tag)
+        elif revision is None and _REVISION.match(tag):
+            revision = tag
+        else:
+            flags.append(tag)
+    return RomName(standardize_name(full_name[:paren_start]), tuple(tags),
+                   tuple(regions), tuple(languages), revision, tuple(flags))
+
+
+@lru_cache(maxsize=1 << 17)
+def title_words(name):
+    """Returns the words of a game title, normalized for comparison
+
+    Tags are dropped, the title is standardized, roman numerals become
+    numbers and articles are removed.
+    """
+    return tuple(
+        ROMAN_NUMERALS.get(word, word)
+        for word in parse_name(name).name.split() if word not in ARTICLES)
+
+
+def blocking_key(words):
+    """Returns a coarse key that similar titles are likely to share
+
+    The first two words and the sequel number (the last number) are used, so
+    only titles in the same block need comparing.
+    """
+    number = next((word for word in reversed(words) if word.isdigit()), "")
+    return words[:2] + (number, )
+
+
+@lru_cache(maxsize=1 << 17)
+def parse(path):
+    """Returns the RomName for the rom at path"""
+    return parse_name(os.path.splitext(os.path.basename(path))[0])
+
+
+def rom_name_and_tags(path):
+    """Returns the standardized name of a rom, and its tags"""
+    parsed = parse(path)
+    return parsed.name, parsed.tags
+
+
+def _benchmark_names(count):
+    """Makes up `count` distinct No-Intro style file names"""
+    titles = ("Sonic the Hedgehog", "Super Mario Bros. 3", "Tom & Jerry",
+              "Street Fighter II' - Champion Edition", "Pac-Man",
+              "Legend of Zelda, The - A Link to the Past")
+    tag_sets = ("(USA)", "(Europe) (En,Fr,De)", "(Japan) (Rev 1)",
+                "(USA, Europe) (Beta)", "(World) (v1.1)", "(Japan) (Proto)",
+                "(USA) (Virtual Console)", "(Unl)")
+    return [
+        f"{titles[i % len(titles)]} {i // len(tag_sets)} "
+        f"{tag_sets[i % len(tag_sets)]}.zip" for i in range(count)
+    ]
+
+
+def benchmark(names):
+    """Prints how long parsing names takes, cold and memoized"""
+    parse.cache_clear()
+    parse_name.cache_clear()
+    start = time.perf_counter()
+    for name in names:
+        rom_name_and_tags(name)
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    for name in names:
+        rom_name_and_tags(name)
+    warm = time.perf_counter() - start
+    print(f"Parsed {len(names)} names: {cold * 1000:.0f}ms, "
+          f"{warm * 1000:.0f}ms memoized")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "r") as handle:
+            benchmark([line.strip() for line in handle if line.strip()])
+    else:
+        benchmark(_benchmark_names(100000))
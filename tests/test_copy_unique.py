@@ -0,0 +1,55 @@
+import os
+
+import copy_unique
+
+
+def make_roms(directory, names):
+    os.makedirs(directory, exist_ok=True)
+    for name in names:
+        with open(os.path.join(directory, name), "w") as handle:
+            handle.write(name)
+
+
+def run(source, target, blacklist=frozenset()):
+    return copy_unique.copy_roms(source, r"^\[", target, "zip", "copy",
+                                 True, False, None, set(blacklist), jobs=2)
+
+
+def test_rerun_from_another_directory(tmp_path, monkeypatch):
+    make_roms(tmp_path / "src", ["Sonic (USA).zip", "Tetris (USA).zip"])
+    # Same relative target as the first run, but from somewhere else
+    make_roms(tmp_path / "other" / "dst", ["Sonic (USA).zip"])
+
+    monkeypatch.chdir(tmp_path)
+    result = run("src", "dst")
+    assert result["copied"] == 2
+
+    monkeypatch.chdir(tmp_path / "other")
+    result = run(str(tmp_path / "src"), str(tmp_path / "dst"))
+    assert result["unchanged"] == 2
+    assert result["removed"] == 0
+    assert sorted(os.listdir(tmp_path / "other" / "dst")) == [
+        "Sonic (USA).zip"
+    ]
+    assert sorted(name for name in os.listdir(tmp_path / "dst")
+                  if not name.startswith(".")) == [
+                      "Sonic (USA).zip", "Tetris (USA).zip"
+                  ]
+
+    # Removals still happen, inside the target folder only
+    monkeypatch.chdir(tmp_path)
+    result = run("src", "dst", blacklist={"tetris"})
+    assert result["removed"] == 1
+    assert not os.path.exists(tmp_path / "dst" / "Tetris (USA).zip")
+    assert os.path.exists(tmp_path / "other" / "dst" / "Sonic (USA).zip")
+
+
+def test_missing_target_is_restored(tmp_path, monkeypatch):
+    make_roms(tmp_path / "src", ["Game C (World).zip"])
+    monkeypatch.chdir(tmp_path)
+    run("src", "dst")
+    os.remove(tmp_path / "dst" / "Game C (World).zip")
+
+    result = run("src", "dst")
+    assert result["copied"] == 1
+    assert os.path.exists(tmp_path / "dst" / "Game C (World).zip")
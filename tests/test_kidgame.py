@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+# kidgame needs ffmpeg-python even for actions that don't touch videos
+pytest.importorskip("ffmpeg")
+import kidgame  # noqa: E402
+
+
+def write(path, text=""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as handle:
+        handle.write(text)
+
+
+def test_merged_games_survive_clean(tmp_path):
+    roms = tmp_path / "roms"
+    write(str(roms / "nes" / "Mario (USA).nes"))
+    write(str(roms / "nes" / "Metroid (USA).nes"))
+    write(
+        str(roms / "nes" / "gamelist.xml"), '<?xml version="1.0"?>\n'
+        "<gameList><game><path>./Mario (USA).nes</path><name>Mario</name>"
+        "<favorite>true</favorite></game></gameList>\n")
+    scrape = tmp_path / "scrape"
+    write(str(scrape / "media" / "metroid.png"))
+    write(
+        str(scrape / "gamelist.xml"), '<?xml version="1.0"?>\n'
+        "<gameList><game><path>./Mario (USA).nes</path><name>Mario NEW"
+        "</name><hidden>true</hidden></game>"
+        "<game><path>./Metroid (USA).nes</path><name>Metroid</name>"
+        "<image>./media/metroid.png</image></game></gameList>\n")
+
+    gamelists = kidgame.Gamelists(["nes"],
+                                  dirs=(str(roms), ),
+                                  format_cache=str(tmp_path / "cache.json"))
+    system = gamelists.get_system("nes")
+    system.merge_scrape(str(scrape / "gamelist.xml"))
+    system.clean()
+
+    games = {game.name: game for game in system.games}
+    assert sorted(games) == ["Mario (USA)", "Metroid (USA)"]
+    assert games["Mario (USA)"].is_type("favorite")
+    assert not games["Mario (USA)"].is_type("hidden")
+    assert games["Metroid (USA)"].get_path("image") == str(
+        scrape / "media" / "metroid.png")
+
+
+def test_clean_media_matches_extensions_in_any_case(tmp_path):
+    roms = tmp_path / "roms"
+    media = roms / "nes" / "media"
+    write(str(roms / "nes" / "Mario (USA).nes"))
+    write(str(media / "mario.png"))
+    write(str(media / "orphan.PNG"), "12345")
+    write(str(media / "notes.txt"))
+    write(
+        str(roms / "nes" / "gamelist.xml"), '<?xml version="1.0"?>\n'
+        "<gameList><game><path>./Mario (USA).nes</path><name>Mario</name>"
+        "<image>./media/mario.png</image></game></gameList>\n")
+
+    gamelists = kidgame.Gamelists(["nes"],
+                                  dirs=(str(roms), ),
+                                  format_cache=str(tmp_path / "cache.json"))
+    kidgame.clean_media(gamelists, False)
+
+    assert sorted(os.listdir(str(media))) == ["mario.png", "notes.txt"]
+    assert gamelists.change_log.count("files", "nes") == 1
@@ -0,0 +1,431 @@
+"""Reads the properties of MP4 and MKV videos straight from their headers
+
+Only the container headers (the MP4 `moov` box or the MKV `Tracks`) are
+read, through mmap, so probing a video takes milliseconds instead of the
+cost of starting an ffprobe process. `probe` returns None for anything it
+does not understand so the caller can fall back to ffprobe.
+"""
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+# H.264 profiles whose SPS carries chroma format and bit depth
+_H264_HIGH_PROFILES = (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139,
+                       134, 135)
+
+_MP4_VIDEO_CODECS = {b"avc1": "h264", b"avc3": "h264",
+                     b"hvc1": "hevc", b"hev1": "hevc"}
+_MKV_VIDEO_CODECS = {"V_MPEG4/ISO/AVC": "h264", "V_MPEGH/ISO/HEVC": "hevc"}
+
+# MKV element ids
+_EBML = 0x1A45DFA3
+_SEGMENT = 0x18538067
+_CLUSTER = 0x1F43B675
+_INFO = 0x1549A966
+_TIMESTAMP_SCALE = 0x2AD7B1
+_DURATION = 0x4489
+_TRACKS = 0x1654AE6B
+_TRACK_ENTRY = 0xAE
+_TRACK_TYPE = 0x83
+_CODEC_ID = 0x86
+_CODEC_PRIVATE = 0x63A2
+_VIDEO = 0xE0
+_PIXEL_WIDTH = 0xB0
+_PIXEL_HEIGHT = 0xBA
+_AUDIO = 0xE1
+_CHANNELS = 0x9F
+
+
+class _BitReader:
+    """Reads bits and exp-golomb codes from an H.264 RBSP"""
+    def __init__(self, data):
+        """Constructor"""
+        self._data = data
+        self._position = 0
+
+    def bit(self):
+        """Reads one bit"""
+        byte = self._data[self._position >> 3]
+        value = (byte >> (7 - (self._position & 7))) & 1
+        self._position += 1
+        return value
+
+    def bits(self, count):
+        """Reads an unsigned integer of `count` bits"""
+        value = 0
+        for _ in range(count):
+            value = (value << 1) | self.bit()
+        return value
+
+    def ue(self):
+        """Reads an unsigned exp-golomb code"""
+        zeros = 0
+        while not self.bit():
+            zeros += 1
+            if zeros > 31:
+                raise ValueError("Invalid exp-golomb code")
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self):
+        """Reads a signed exp-golomb code"""
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def _pix_fmt(chroma_format, bit_depth, full_range=False):
+    """Returns the ffmpeg name of a pixel format"""
+    base = {0: "gray", 1: "yuv420p", 2: "yuv422p", 3: "yuv444p"}.get(
+        chroma_format)
+    if base is None:
+        return None
+    if bit_depth != 8:
+        return f"{base}{bit_depth}le"
+    if full_range and chroma_format:
+        return base.replace("yuv", "yuvj")
+    return base
+
+
+def _parse_h264_sps(nal):
+    """Returns (pix_fmt, width, height) from an H.264 SPS NAL unit"""
+    # Strip the NAL header and emulation prevention bytes
+    reader = _BitReader(bytes(nal[1:]).replace(b"\x00\x00\x03", b"\x00\x00"))
+    profile = reader.bits(8)
+    reader.bits(16)  # Constraint flags and level
+    reader.ue()  # seq_parameter_set_id
+    chroma_format, bit_depth = 1, 8
+    if profile in _H264_HIGH_PROFILES:
+        chroma_format = reader.ue()
+        if chroma_format == 3:
+            reader.bit()  # separate_colour_plane_flag
+        bit_depth = reader.ue() + 8
+        reader.ue()  # bit_depth_chroma_minus8
+        reader.bit()  # qpprime_y_zero_transform_bypass_flag
+        if reader.bit():
+            # Skip the scaling matrices
+            for i in range(12 if chroma_format == 3 else 8):
+                if reader.bit():
+                    last, following = 8, 8
+                    for _ in range(16 if i < 6 else 64):
+                        if following:
+                            following = (last + reader.se() + 256) % 256
+                        last = following or last
+    reader.ue()  # log2_max_frame_num_minus4
+    order_type = reader.ue()
+    if order_type == 0:
+        reader.ue()
+    elif order_type == 1:
+        reader.bit()
+        reader.se()
+        reader.se()
+        for _ in range(reader.ue()):
+            reader.se()
+    reader.ue()  # max_num_ref_frames
+    reader.bit()  # gaps_in_frame_num_value_allowed_flag
+    width = (reader.ue() + 1) * 16
+    height_map_units = reader.ue() + 1
+    frame_mbs_only = reader.bit()
+    height = (2 - frame_mbs_only) * height_map_units * 16
+    if not frame_mbs_only:
+        reader.bit()
+    reader.bit()  # direct_8x8_inference_flag
+    if reader.bit():
+        crop_x = 1 if chroma_format in (0, 3) else 2
+        crop_y = (2 if chroma_format == 1 else 1) * (2 - frame_mbs_only)
+        left, right, top, bottom = (reader.ue() for _ in range(4))
+        width -= crop_x * (left + right)
+        height -= crop_y * (top + bottom)
+    full_range = False
+    if reader.bit():  # vui_parameters_present_flag
+        if reader.bit():  # aspect_ratio_info_present_flag
+            if reader.bits(8) == 255:
+                reader.bits(32)
+        if reader.bit():  # overscan_info_present_flag
+            reader.bit()
+        if reader.bit():  # video_signal_type_present_flag
+            reader.bits(3)
+            full_range = bool(reader.bit())
+    return _pix_fmt(chroma_format, bit_depth, full_range), width, height
+
+
+def _parse_avcc(data):
+    """Returns (pix_fmt, width, height) from an avcC configuration record"""
+    if len(data) < 8 or not data[5] & 0x1F:
+        return None
+    length = struct.unpack_from(">H", data, 6)[0]
+    return _parse_h264_sps(data[8:8 + length])
+
+
+def _parse_hvcc(data):
+    """Returns the pix_fmt from an hvcC configuration record"""
+    if len(data) < 23:
+        return None
+    return _pix_fmt(data[16] & 0x03, (data[17] & 0x07) + 8)
+
+
+def _boxes(data, start, end):
+    """Yields (type, payload start, end) of the MP4 boxes in a range"""
+    position = start
+    while position + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, position)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, position + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - position
+        if size < header or position + size > end:
+            return
+        yield box_type, position + header, position + size
+        position += size
+
+
+def _child(data, start, end, *path):
+    """Returns the (start, end) of the first box found by following path"""
+    for box_type in path:
+        for child_type, child_start, child_end in _boxes(data, start, end):
+            if child_type == box_type:
+                start, end = child_start, child_end
+                break
+        else:
+            return None
+    return start, end
+
+
+def _time_header(data, start):
+    """Returns (timescale, duration) of an mvhd or mdhd box"""
+    if data[start] == 1:
+        return struct.unpack_from(">IQ", data, start + 20)
+    return struct.unpack_from(">II", data, start + 12)
+
+
+def _probe_mp4(data):
+    """Returns the properties of the video in an MP4 container"""
+    moov = _child(data, 0, len(data), b"moov")
+    if moov is None:
+        return None
+    mvhd = _child(data, *moov, b"mvhd")
+    if mvhd is None:
+        return None
+    timescale, duration = _time_header(data, mvhd[0])
+    info = {
+        "duration": duration / timescale if timescale else 0,
+        "audio_channels": 0
+    }
+    found_video = False
+    for box_type, start, end in _boxes(data, *moov):
+        if box_type != b"trak":
+            continue
+        hdlr = _child(data, start, end, b"mdia", b"hdlr")
+        mdhd = _child(data, start, end, b"mdia", b"mdhd")
+        stbl = _child(data, start, end, b"mdia", b"minf", b"stbl")
+        if hdlr is None or mdhd is None or stbl is None:
+            continue
+        handler = bytes(data[hdlr[0] + 8:hdlr[0] + 12])
+        stsd = _child(data, *stbl, b"stsd")
+        if stsd is None:
+            continue
+        entry = next(_boxes(data, stsd[0] + 8, stsd[1]), None)
+        if entry is None:
+            continue
+        entry_type, entry_start, entry_end = entry
+
+        if handler == b"soun" and not info["audio_channels"]:
+            info["audio_channels"] = struct.unpack_from(
+                ">H", data, entry_start + 16)[0]
+        elif handler == b"vide" and not found_video:
+            codec = _MP4_VIDEO_CODECS.get(entry_type)
+            if codec is None:
+                return None
+            width, height = struct.unpack_from(">HH", data, entry_start + 24)
+            config = _child(data, entry_start + 78, entry_end,
+                            b"avcC" if codec == "h264" else b"hvcC")
+            if config is None:
+                return None
+            record = data[config[0]:config[1]]
+            if codec == "h264":
+                parsed = _parse_avcc(record)
+                if parsed is None:
+                    return None
+                pix_fmt, width, height = parsed
+            else:
+                pix_fmt = _parse_hvcc(record)
+
+            # Bitrate is the total size of the samples over the track duration
+            track_scale, track_duration = _time_header(data, mdhd[0])
+            stsz = _child(data, *stbl, b"stsz")
+            bit_rate = 0
+            if stsz is not None and track_scale and track_duration:
+                sample_size, count = struct.unpack_from(
+                    ">II", data, stsz[0] + 4)
+                if sample_size:
+                    total = sample_size * count
+                else:
+                    sizes = array("I")
+                    sizes.frombytes(data[stsz[0] + 12:stsz[0] + 12 +
+                                         4 * count])
+                    if sizes.itemsize != 4:
+                        return None
+                    if sys.byteorder == "little":
+                        sizes.byteswap()
+                    total = sum(sizes)
+                bit_rate = int(total * 8 * track_scale / track_duration)
+            info.update({
+                "codec": codec,
+                "pix_fmt": pix_fmt,
+                "width": width,
+                "height": height,
+                "bit_rate": bit_rate,
+                "total_bit_rate": False
+            })
+            found_video = True
+    return info if found_video and info["pix_fmt"] else None
+
+
+def _vint(data, position, keep_marker=False):
+    """Reads an EBML variable length integer, returning (value, length)"""
+    first = data[position]
+    mask, length = 0x80, 1
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise ValueError("Invalid EBML integer")
+    value = first if keep_marker else first & (mask - 1)
+    for byte in data[position + 1:position + length]:
+        value = (value << 8) | byte
+    return value, length
+
+
+def _elements(data, start, end):
+    """Yields (id, payload start, end) of the EBML elements in a range"""
+    position = start
+    while position < end:
+        element_id, length = _vint(data, position, True)
+        position += length
+        size, length = _vint(data, position)
+        position += length
+        if size == (1 << (7 * length)) - 1:
+            # Unknown size, runs to the end of the parent
+            stop = end
+        else:
+            stop = min(position + size, end)
+        yield element_id, position, stop
+        position = stop
+
+
+def _uint(data, start, end):
+    """Reads an EBML unsigned integer"""
+    return int.from_bytes(data[start:end], "big")
+
+
+def _probe_mkv(data):
+    """Returns the properties of the video in an MKV/WebM container"""
+    segment = None
+    for element_id, start, end in _elements(data, 0, len(data)):
+        if element_id == _SEGMENT:
+            segment = start, end
+            break
+    if segment is None:
+        return None
+
+    info = {
+        "duration": 0,
+        "audio_channels": 0,
+        "bit_rate": 0,
+        "total_bit_rate": True
+    }
+    scale, duration = 1000000, 0
+    video = None
+    for element_id, start, end in _elements(data, *segment):
+        if element_id == _CLUSTER:
+            # Headers are done, the rest is media data
+            break
+        if element_id == _INFO:
+            for child_id, child_start, child_end in _elements(
+                    data, start, end):
+                if child_id == _TIMESTAMP_SCALE:
+                    scale = _uint(data, child_start, child_end)
+                elif child_id == _DURATION:
+                    duration = struct.unpack(
+                        ">f" if child_end - child_start == 4 else ">d",
+                        data[child_start:child_end])[0]
+        elif element_id == _TRACKS:
+            for entry_id, entry_start, entry_end in _elements(
+                    data, start, end):
+                if entry_id != _TRACK_ENTRY:
+                    continue
+                track = {}
+                for child_id, child_start, child_end in _elements(
+                        data, entry_start, entry_end):
+                    if child_id in (_VIDEO, _AUDIO):
+                        for field_id, field_start, field_end in _elements(
+                                data, child_start, child_end):
+                            track[field_id] = _uint(data, field_start,
+                                                    field_end)
+                    elif child_id == _CODEC_ID:
+                        track[child_id] = bytes(
+                            data[child_start:child_end]).rstrip(
+                                b"\x00").decode("ascii", "replace")
+                    elif child_id == _CODEC_PRIVATE:
+                        track[child_id] = data[child_start:child_end]
+                    elif child_id == _TRACK_TYPE:
+                        track[child_id] = _uint(data, child_start, child_end)
+                if track.get(_TRACK_TYPE) == 1 and video is None:
+                    video = track
+                elif track.get(_TRACK_TYPE) == 2 and not info[
+                        "audio_channels"]:
+                    info["audio_channels"] = track.get(_CHANNELS, 1)
+
+    if video is None:
+        return None
+    codec = _MKV_VIDEO_CODECS.get(video.get(_CODEC_ID))
+    private = video.get(_CODEC_PRIVATE)
+    if codec is None or private is None:
+        return None
+    width, height = video.get(_PIXEL_WIDTH, 0), video.get(_PIXEL_HEIGHT, 0)
+    if codec == "h264":
+        parsed = _parse_avcc(private)
+        if parsed is None:
+            return None
+        pix_fmt = parsed[0]
+    else:
+        pix_fmt = _parse_hvcc(private)
+    if pix_fmt is None:
+        return None
+    info["duration"] = duration * scale / 1e9
+    if info["duration"]:
+        # Like ffprobe, fall back to the bitrate of the whole file
+        info["bit_rate"] = int(len(data) * 8 / info["duration"])
+    info.update({
+        "codec": codec,
+        "pix_fmt": pix_fmt,
+        "width": width,
+        "height": height
+    })
+    return info
+
+
+def probe(path):
+    """Returns the properties of a video, or None if it can't be parsed
+
+    The result has the same keys as kidgame.probe_video.
+    """
+    with open(path, "rb") as handle:
+        size = os.fstat(handle.fileno()).st_size
+        if size < 16:
+            return None
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            try:
+                if data[4:8] == b"ftyp":
+                    info = _probe_mp4(data)
+                elif struct.unpack_from(">I", data)[0] == _EBML:
+                    info = _probe_mkv(data)
+                else:
+                    return None
+            except (struct.error, IndexError, ValueError):
+                return None
+    if info is not None:
+        info["size"] = size
+    return info
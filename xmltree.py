@@ -0,0 +1,153 @@
+"""XML backend for gamelists: lxml when it's installed, ElementTree otherwise
+
+Both backends produce trees with the same interface. lxml parses, writes
+and filters children by tag in C, which makes a big difference on gamelists
+with tens of thousands of games. (Compiled XPath was tried for selecting
+children, but it's slower than iterchildren because every result still
+needs a Python proxy and its parent looked up.)
+
+Run `python3 xmltree.py [gamelist.xml]` to benchmark the backends.
+"""
+import os
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ElementTree
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+
+class ElementTreeBackend:
+    """The standard library's xml.etree"""
+    name = "ElementTree"
+    etree = ElementTree
+
+    def parse(self, path):
+        """Returns the tree of the xml file at path"""
+        return ElementTree.parse(path)
+
+    def iterparse(self, path, tags):
+        """Yields each element in tags once it's read, freeing earlier ones"""
+        context = ElementTree.iterparse(path, events=("start", "end"))
+        _, root = next(context)
+        for event, element in context:
+            if event == "end" and element.tag in tags:
+                yield element
+                root.clear()
+
+    def select_children(self, root, tags):
+        """Returns (element, child) for children of root's children in tags"""
+        return [(element, child) for element in root for child in element
+                if child.tag in tags]
+
+    def write(self, tree, path):
+        """Writes tree to path"""
+        tree.write(path, xml_declaration=True, encoding="UTF-8")
+
+
+class LxmlBackend(ElementTreeBackend):
+    """lxml, a binding to the C library libxml2"""
+    name = "lxml"
+    etree = lxml_etree
+
+    def __init__(self):
+        """Constructor"""
+        # Comments would show up as games otherwise
+        self._parser = lxml_etree.XMLParser(remove_comments=True)
+
+    def parse(self, path):
+        """Returns the tree of the xml file at path"""
+        return lxml_etree.parse(path, self._parser)
+
+    def iterparse(self, path, tags):
+        """Yields each element in tags once it's read, freeing earlier ones"""
+        for _, element in lxml_etree.iterparse(path,
+                                               events=("end", ),
+                                               tag=tags,
+                                               remove_comments=True):
+            yield element
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    def select_children(self, root, tags):
+        """Returns (element, child) for children of root's children in tags"""
+        tags = tuple(tags)
+        return [(element, child) for element in root
+                for child in element.iterchildren(*tags)]
+
+
+ELEMENT_TREE = ElementTreeBackend()
+LXML = LxmlBackend() if lxml_etree is not None else None
+
+backend = LXML or ELEMENT_TREE
+ET = backend.etree
+parse = backend.parse
+iterparse = backend.iterparse
+select_children = backend.select_children
+write = backend.write
+
+
+def _benchmark_gamelist(path, count):
+    """Writes a made up gamelist with `count` games to path"""
+    with open(path, "w") as handle:
+        handle.write('<?xml version="1.0"?>\n<gameList>\n')
+        for i in range(count):
+            handle.write(
+                f"<game><path>./Game {i} (USA).zip</path>"
+                f"<name>Game {i}</name><desc>{'A long description. ' * 20}"
+                f"</desc><image>./images/{i}.png</image>"
+                f"<video>./videos/{i}.mp4</video><developer>Dev</developer>"
+                f"<publisher>Pub</publisher><genre>Platform / Action</genre>"
+                f"<md5>{i:032x}</md5></game>\n")
+        handle.write("</gameList>\n")
+
+
+def benchmark(path):
+    """Prints how long each backend takes on the gamelist at path"""
+    backends = [ELEMENT_TREE] + ([LXML] if LXML is not None else [])
+    if LXML is None:
+        print("lxml isn't installed, only timing ElementTree")
+    output = f"{path}.benchmark"
+    for candidate in backends:
+        timings = []
+        start = time.perf_counter()
+        tree = candidate.parse(path)
+        timings.append(("parse", time.perf_counter() - start))
+
+        start = time.perf_counter()
+        for game in tree.getroot():
+            game.find("image")
+            game.find("video")
+        timings.append(("find", time.perf_counter() - start))
+
+        start = time.perf_counter()
+        candidate.select_children(tree.getroot(), ("image", "video"))
+        timings.append(("select", time.perf_counter() - start))
+
+        start = time.perf_counter()
+        candidate.write(tree, output)
+        timings.append(("write", time.perf_counter() - start))
+
+        start = time.perf_counter()
+        for _ in candidate.iterparse(path, ("game", )):
+            pass
+        timings.append(("iterparse", time.perf_counter() - start))
+
+        print(f"{candidate.name:>12}: " +
+              ", ".join(f"{label} {seconds * 1000:.0f}ms"
+                        for label, seconds in timings))
+    os.remove(output)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        benchmark(sys.argv[1])
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            gamelist = os.path.join(directory, "gamelist.xml")
+            _benchmark_gamelist(gamelist, 20000)
+            benchmark(gamelist)